@@ -8,7 +8,31 @@ import yaml
 import os
 
 
-settings_filename = os.path.join(os.path.dirname(__file__), 'settings.yaml')
+# MEDKNOW_SETTINGS points to another settings file (e.g. the one of the tests)
+settings_filename = os.environ.get('MEDKNOW_SETTINGS',
+                                   os.path.join(os.path.dirname(__file__), 'settings.yaml'))
 #settings_filename = '../'
 with open(settings_filename, "r") as f:
-    settings = yaml.load(f)
\ No newline at end of file
+    settings = yaml.load(f)
+
+def get_setting(keys, default=None):
+    """
+    Helper to fetch a nested value from settings, falling back
+    to a default when any of the keys is missing. Useful for
+    optional variables that older settings.yaml files lack.
+    Input:
+        - keys: list,
+        list of nested keys (e.g. ['semrep', 'persistent'])
+        - default: object,
+        value to return if the variable is not found
+    Output:
+        - the value found in settings or the default
+    """
+
+    value = settings
+    for key in keys:
+        try:
+            value = value[key]
+        except (KeyError, TypeError):
+            return default
+    return value
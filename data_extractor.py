@@ -8,23 +8,33 @@
 # services.
 
 
+import os
+import re
+import copy
 import json
+import bisect
+import time
+import atexit
+import select
 import subprocess
 import urllib2
-import pymongo
-import numpy as np
 from nltk.tokenize import sent_tokenize
-from config import settings
+from config import settings, get_setting
 from pymetamap import MetaMap
+from sentence_cache import get_sentence_cache
+from extraction_store import text_fingerprint
 from utilities import time_log, get_concept_from_cui, get_concept_from_source
 from itertools import product
-from multiprocessing import cpu_count, Pool
+from workers import get_pool, get_num_workers, get_mongo_client, pack_payload, unpack_payload, \
+                    pickled_size, log_ipc_sizes
 from unidecode import unidecode
 
 def metamap_wrapper(text):
     """
     Function-wrapper for metamap binary. Extracts concepts
-    found in text.
+    found in text. If metamap persistent is set in settings, the
+    sentences are streamed through a long-lived MetaMap process
+    instead of launching the binary for every text.
 
     !!!! REMEMBER TO START THE METAMAP TAGGER AND
         WordSense DISAMBIGUATION SERVER !!!!
@@ -37,32 +47,161 @@ def metamap_wrapper(text):
        a list of the concepts found
     """
 
+    if str(get_setting(['metamap', 'persistent'], False)) == 'True':
+        try:
+            return metamap_process_wrapper([text])[0]
+        except (IOError, OSError), e:
+            time_log('Falling back to a single MetaMap call: %s' % e)
+    return metamap_instance_wrapper(text)
+
+
+def metamap_batch_wrapper(texts):
+    """
+    Function-wrapper for metamap binary on many texts. Uses the
+    long-lived MetaMap process if metamap persistent is set, submitting
+    the sentences of all the texts at once.
+    Input:
+        - texts: list,
+        list of pieces of text
+    Output:
+        - results: list,
+        list of dictionaries, one for each text, as generated from
+        metamap_wrapper
+    """
+
+    if str(get_setting(['metamap', 'persistent'], False)) == 'True':
+        try:
+            return metamap_process_wrapper(texts)
+        except (IOError, OSError), e:
+            time_log('Falling back to a single MetaMap call per text: %s' % e)
+    return [metamap_instance_wrapper(text) for text in texts]
+
+
+def metamap_process_wrapper(texts):
+    """
+    Extract the concepts of many texts through the long-lived MetaMap
+    process of the current (worker) process.
+    Input:
+        - texts: list,
+        list of pieces of text
+    Output:
+        - results: list,
+        list of dictionaries, one for each text, as generated from
+        metamap_wrapper
+    """
+
+    docs = [metamap_text_sents(text) for text in texts]
+    lines = get_metamap_process().process(docs)
+    results = []
+    for text, doc_lines in zip(texts, lines):
+        sentences = metamap_sentences([parse_mmi_lines(sent_lines) for sent_lines in doc_lines])
+        results.append({'sents': sentences, 'sent_text': text})
+    return results
+
+
+def group_metamap_concepts(concepts, N):
+    """
+    Group the concepts pymetamap found in N sentences by the sentence
+    they were found in, in one pass.
+    Input:
+        - concepts: list,
+        list of pymetamap concepts, with the sentence position as index
+        - N: int,
+        number of sentences
+    Output:
+        - sent_records: list,
+        list of N lists with the records (see mmi_record) of the concepts
+        of each sentence
+    """
+
+    sent_records = [[] for i in xrange(N)]
+    for concept in concepts:
+        record = mmi_record(concept)
+        if record is None:
+            continue
+        i = int(concept[0])
+        if 0 <= i < N:
+            sent_records[i].append(record)
+    return sent_records
+
+
+def mmi_record(fields):
+    """
+    Compact record of a MetaMap concept.
+    Input:
+        - fields: tuple or list,
+        a pymetamap concept or the split fields of an MMI output line,
+        which share the same layout (index, MMI, score, preferred name,
+        cui, semantic types, ...)
+    Output:
+        - (label, cui, sem_types, score) tuple, None if not a concept
+        (e.g. an abbreviation, AA)
+    """
+
+    if len(fields) > 5 and fields[1] == 'MMI':
+        return (fields[3], fields[4], fields[5], fields[2])
+    return None
+
+
+def metamap_sentences(sent_records):
+    """
+    Build the sentences of the MetaMap results from the concept records
+    of each sentence.
+    Input:
+        - sent_records: list,
+        list of lists with the records of the concepts of each sentence
+    Output:
+        - sentences: list,
+        list of sentence dictionaries, numbered from 1, with their
+        entities
+    """
+
+    return [{'sent_id': i + 1, 'relations': [],
+             'entities': [dict(zip(METAMAP_ENTITY_KEYS, record)) for record in records]}
+            for i, records in enumerate(sent_records)]
+
+
+def metamap_text_sents(text):
+    """
+    Clean a piece of text, convert it to ascii and break it into the
+    sentences given to MetaMap, the same with or without the long-lived
+    process.
+    Input:
+        - text: str,
+        a piece of text
+    Output:
+        - sents: list,
+        list of sentences
+    """
+
+    return sent_tokenize(prepare_semrep_text(text))
+
+
+def metamap_instance_wrapper(text):
+    """
+    Extract the concepts of a text with the MetaMap instance of
+    pymetamap, which launches the metamap binary.
+    Input:
+        - text: str,
+        a piece of text or sentence
+    Output:
+       - a dictionary with key sents and values
+       a list of the concepts found
+    """
+
     # Tokenize into sentences
-    sents = sent_tokenize(text)
+    sents = metamap_text_sents(text)
     # Load Metamap Instance
     mm = MetaMap.get_instance(settings['load']['path']['metamap'])
     concepts, errors = mm.extract_concepts(sents, range(len(sents)))
-    # Keep the sentence ids
-    ids = np.array([int(concept[0]) for concept in concepts])
-    sentences = []
-    for i in xrange(len(sents)):
-        tmp = {'sent_id': i+1, 'entities': [], 'relations': []}
-        # Wanted concepts according to sentence
-        wanted = np.where(ids == i)[0].tolist()
-        for w_ind in wanted:
-            w_conc = concepts[w_ind]
-            if hasattr(w_conc, 'cui'):
-                tmp_conc = {'label': w_conc.preferred_name, 'cui': w_conc.cui,
-                            'sem_types': w_conc.semtypes, 'score': w_conc.score}
-                tmp['entities'].append(tmp_conc)
-        sentences.append(tmp)
+    sentences = metamap_sentences(group_metamap_concepts(concepts, len(sents)))
     if errors:
         time_log('Errors with extracting concepts!')
         time_log(errors)
     return {'sents': sentences, 'sent_text':text}
 
 
-def runProcess(exe, working_dir):
+def runProcess(exe, working_dir, inp=None):
     """
     Function that opens a command line and runs a command.
     Captures the output and returns.
@@ -71,13 +210,21 @@ def runProcess(exe, working_dir):
         string of the command to be run. ! REMEMBER TO ESCAPE CHARS!
         - working_dir: str,
         directory where the cmd should be executed
+        - inp: str,
+        optional input to be written to the stdin of the command
     Output:
         - lines: list,
         list of strings generated from the command
     """
 
-    p = subprocess.Popen(exe, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=working_dir, shell=True)
-    lines = p.stdout.readlines()
+    if inp is None:
+        p = subprocess.Popen(exe, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=working_dir, shell=True)
+        lines = p.stdout.readlines()
+    else:
+        p = subprocess.Popen(exe, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             cwd=working_dir, shell=True)
+        out, _ = p.communicate(inp)
+        lines = out.splitlines(True)
     return lines
 
 
@@ -329,7 +476,9 @@ def extract_entities(text, json_={}):
 def extract_metamap(json_, key):
     """
     Task function to parse and extract concepts from json_ style dic, using
-    the MetaMap binary.
+    the MetaMap binary. The texts (or 5000-char chunks) of the documents
+    are given to MetaMap in batches of at most metamap batch_docs texts
+    and metamap batch_chars characters.
     Input:
         - json_ : dic,
         json-style dictionary generated from the Parse object related
@@ -346,24 +495,25 @@ def extract_metamap(json_, key):
     # textfield to read text from
     textfield = settings['out']['json']['json_text_field']
     N = len(json_[docfield])
+    max_docs = int(get_setting(['metamap', 'batch_docs'], 200))
+    max_chars = int(get_setting(['metamap', 'batch_chars'], 200000))
+    texts = [clean_text(doc[textfield]) for doc in json_[docfield]]
+    units = []
+    owners = []
+    for i, text in enumerate(texts):
+        for unit in semrep_text_units(text):
+            units.append(unit)
+            owners.append(i)
+    batches = create_semrep_batches(units, max_docs, max_chars)
+    unit_results = []
+    for j, batch in enumerate(batches):
+        unit_results.extend(metamap_batch_wrapper([units[ind] for ind in batch]))
+        time_log('Completed MetaMap batch %d/%d with %d texts' % (j + 1, len(batches), len(batch)))
+    doc_results = [[] for i in xrange(N)]
+    for owner, results in zip(owners, unit_results):
+        doc_results[owner].append(results)
     for i, doc in enumerate(json_[docfield]):
-        text = clean_text(doc[textfield])
-        if len(text) > 5000:
-            chunks = create_text_batches(text)
-            results = {'text': text, 'sents': []}
-            sent_id = 0
-            for chunk in chunks:
-                tmp = metamap_wrapper(chunk)
-                for sent in tmp['sents']:
-                    sent['sent_id'] = sent_id
-                    sent_id += 1
-                    results['sents'].append(sent)
-        else:
-            results = metamap_wrapper(text)
-        json_[docfield][i].update(results)
-        proc = int(i/float(N)*100)
-        if proc % 10 == 0 and proc > 0:
-            time_log('We are at %d/%d documents -- %0.2f %%' % (i, N, proc))
+        doc.update(assemble_semrep_units(texts[i], doc_results[i]))
     return json_
 
 
@@ -415,14 +565,407 @@ def toAscii_wrapper(text):
     lines = runProcess(cmd, toAscii_dir)
     return lines[0]
 
-def semrep_wrapper(text):
+# SemRep binary and the flags it is called with. Only -F is supported
+# by parse_semrep_lines, cause the resulting lines are split by position.
+SEMREP_BIN = './semrep.v1.7'
+SEMREP_FLAGS = '-L 2015 -Z 2015AA -F'
+
+# Mapping of the elements of SemRep -F output lines to fields
+SEMREP_MAPPINGS = {
+    "text": {
+        "sent_id": 4,
+        "sent_text": 6
+    },
+    "entity": {
+        'cuid': 6,
+        'label': 7,
+        'sem_types': 8,
+        'score': 15
+    },
+    "relation": {
+        'subject__cui': 8,
+        'subject__label': 9,
+        'subject__sem_types': 10,
+        'subject__sem_type': 11,
+        'subject__score': 18,
+        'predicate__type': 21,
+        'predicate': 22,
+        'negation': 23,
+        'object__cui': 28,
+        'object__label': 29,
+        'object__sem_types': 30,
+        'object__sem_type': 31,
+        'object__score': 38,
+    }
+}
+
+# Order of the fields when packing sentences to tuples for IPC
+SEMREP_ENTITY_KEYS = tuple(sorted(SEMREP_MAPPINGS['entity']))
+SEMREP_RELATION_KEYS = tuple(sorted(SEMREP_MAPPINGS['relation']))
+
+# Marker sentences used to frame each document fed to SemRep, either
+# streamed through a long-lived process or packed with other documents
+# in one input
+SEMREP_BEGIN_MARKER = 'MEDKNOWBEGIN%d'
+SEMREP_END_MARKER = 'MEDKNOWEND%d'
+SEMREP_MARKER_RE = re.compile(r'MEDKNOW(BEGIN|END)(\d+)')
+
+# The SemRep process kept alive in the current (worker) process
+_SEMREP_PROCESS = None
+
+# Flags of the long-lived MetaMap process: fielded MMI output, with the
+# id before the '|' of each input line kept in its output lines, and an
+# EOT line closing the output of every input line, whatever concepts
+# (if any) were found
+METAMAP_FLAGS = '-N -E --sldiID'
+METAMAP_EOT = '<<< EOT >>>'
+
+# Ids of the sentences fed to MetaMap (batch, document, sentence)
+METAMAP_ID = 'MK%d_%d_%d'
+METAMAP_ID_RE = re.compile(r'MK(\d+)_(\d+)_(\d+)\|')
+
+# Fields of the entities generated from the compact concept records
+METAMAP_ENTITY_KEYS = ('label', 'cui', 'sem_types', 'score')
+
+# The MetaMap process kept alive in the current (worker) process
+_METAMAP_PROCESS = None
+
+
+class SemRepProcess(object):
     """
-    Function wrapper for SemRep binary. It is called with flags
-    -F only and changing this will cause this parsing to fail, cause
-    the resulting lines won't have the same structure.
+    Long-lived SemRep process, fed through its stdin. Each document
+    is written between two marker sentences and the output is read
+    back until the end marker is found, so that the lexicon and models
+    of SemRep are loaded once instead of once per document. The process
+    is restarted after max_docs documents or if it crashes.
+    """
+
+    name = 'SemRep'
+
+    def __init__(self, max_docs=1000, timeout=600):
+        """
+        Initialization of the class.
+        Attributes:
+            - max_docs: int, number of documents after which SemRep
+            is restarted
+            - timeout: int, seconds to wait for SemRep output before
+            considering the process dead
+        """
+
+        self.max_docs = max_docs
+        self.timeout = timeout
+        self.proc = None
+        self.pid = None
+        self.n_docs = 0
+        self.n_markers = 0
+        self._buffer = ''
+
+    def command(self):
+        """
+        The SemRep command line and the directory to run it in.
+        """
+
+        return [SEMREP_BIN] + SEMREP_FLAGS.split(), settings['load']['path']['semrep']
+
+    def start(self):
+        """
+        Start a new process, closing the previous one if alive.
+        """
+
+        self.close()
+        cmd, cwd = self.command()
+        with open(os.devnull, 'w') as devnull:
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=devnull, cwd=cwd)
+        self.pid = os.getpid()
+        self.n_docs = 0
+        self._buffer = ''
+
+    def close(self):
+        """
+        Close stdin of the process and make sure it is gone.
+        """
+
+        # Processes inherited through fork belong to the parent
+        if self.proc is not None and self.pid == os.getpid():
+            try:
+                self.proc.stdin.close()
+                self.proc.kill()
+                self.proc.wait()
+            except (IOError, OSError):
+                pass
+        self.proc = None
+
+    def alive(self):
+        """
+        Check if the process is usable from the current process.
+        """
+
+        return (self.proc is not None and self.pid == os.getpid() and
+                self.proc.poll() is None)
+
+    def _readline(self):
+        """
+        Read one line from the stdout of the process, waiting at most
+        self.timeout seconds for it.
+        """
+
+        while '\n' not in self._buffer:
+            ready, _, _ = select.select([self.proc.stdout], [], [], self.timeout)
+            if not ready:
+                raise IOError('%s produced no output in %d seconds' % (self.name, self.timeout))
+            chunk = os.read(self.proc.stdout.fileno(), 65536)
+            if not chunk:
+                raise IOError('%s process exited' % self.name)
+            self._buffer += chunk
+        line, self._buffer = self._buffer.split('\n', 1)
+        return line + '\n'
+
+    def _communicate(self, texts):
+        """
+        Write the framed documents to SemRep and read back the lines
+        generated for each of them.
+        """
+
+        first = self.n_markers + 1
+        self.n_markers += len(texts)
+        framed, end = frame_semrep_input(texts, first)
+        self.proc.stdin.write(framed)
+        self.proc.stdin.flush()
+        lines = []
+        while True:
+            line = self._readline()
+            if line.startswith('SE'):
+                elements = line.split('|')
+                if len(elements) > 6 and elements[5] == 'text' and end in elements[6]:
+                    break
+                lines.append(line)
+        return split_semrep_output(lines, first, len(texts))
+
+    def process(self, texts):
+        """
+        Run SemRep on a list of texts, (re)starting the process when
+        needed. Retries once on a fresh process after a failure.
+        Input:
+            - texts: list,
+            list of cleaned texts ready for SemRep
+        Output:
+            - list of lists, the SemRep output lines for each text
+        """
+
+        for attempt in xrange(2):
+            if not self.alive() or self.n_docs >= self.max_docs:
+                self.start()
+            try:
+                lines = self._communicate(texts)
+                self.n_docs += len(texts)
+                return lines
+            except (IOError, OSError), e:
+                time_log('%s process failed: %s. Restarting it!' % (self.name, e))
+                self.close()
+        raise IOError('%s process failed twice on the same documents' % self.name)
+
+
+def frame_semrep_input(texts, first=1):
+    """
+    Pack many texts into one SemRep input. Each text is preceded
+    by a unique marker sentence and the input ends with an end marker.
     Input:
+        - texts: list,
+        list of cleaned texts ready for SemRep
+        - first: int,
+        number of the marker of the first text
+    Output:
+        - framed: str,
+        the input to be written to SemRep
+        - end: str,
+        the end marker closing the input
+    """
+
+    parts = []
+    for i, text in enumerate(texts):
+        parts.append('%s.\n\n%s\n\n' % (SEMREP_BEGIN_MARKER % (first + i), text.encode('utf-8')))
+    end = SEMREP_END_MARKER % (first + len(texts) - 1)
+    parts.append('%s.\n\n' % end)
+    return ''.join(parts), end
+
+
+def split_semrep_output(lines, first, N):
+    """
+    Demultiplex the output of SemRep called on an input generated
+    from frame_semrep_input. The lines of the marker sentences
+    themselves are dropped.
+    Input:
+        - lines: list,
+        list of strings as generated from SemRep
+        - first: int,
+        number of the marker of the first text
+        - N: int,
+        number of texts in the input
+    Output:
+        - out: list,
+        list of N lists with the SemRep lines of each text
+    """
+
+    out = [[] for i in xrange(N)]
+    current = None
+    # Lines following a marker sentence belong to it
+    in_marker = False
+    for line in lines:
+        if not line.startswith('SE'):
+            continue
+        elements = line.split('|')
+        if len(elements) > 6 and elements[5] == 'text':
+            found = SEMREP_MARKER_RE.search(elements[6])
+            in_marker = found is not None
+            if in_marker:
+                current = None
+                if found.group(1) == 'BEGIN' and 0 <= int(found.group(2)) - first < N:
+                    current = int(found.group(2)) - first
+                continue
+        if current is not None and not in_marker:
+            out[current].append(line)
+    return out
+
+
+def get_semrep_process():
+    """
+    Get the SemRep process of the current process, creating it if
+    needed. Each pool worker ends up with its own.
+    Output:
+        - SemRepProcess instance
+    """
+
+    global _SEMREP_PROCESS
+    if _SEMREP_PROCESS is None:
+        _SEMREP_PROCESS = SemRepProcess(max_docs=int(get_setting(['semrep', 'max_docs'], 1000)),
+                                        timeout=int(get_setting(['semrep', 'timeout'], 600)))
+        atexit.register(_SEMREP_PROCESS.close)
+    return _SEMREP_PROCESS
+
+
+class MetaMapProcess(SemRepProcess):
+    """
+    Long-lived MetaMap process, fed through its stdin. Each batch of
+    documents is written one sentence per line, prefixed by an id made
+    of the batch, document and sentence numbers (--sldiID), so that the
+    fielded MMI output lines are routed back to their sentence. The
+    output of the batch is read till the EOT line of every sentence.
+    """
+
+    name = 'MetaMap'
+
+    def command(self):
+        """
+        The MetaMap command line and the directory to run it in.
+        """
+
+        cmd = [settings['load']['path']['metamap']] + METAMAP_FLAGS.split()
+        options = get_setting(['metamap', 'options'], None)
+        if options and str(options) != 'None':
+            cmd += str(options).split()
+        return cmd, None
+
+    def _communicate(self, docs):
+        """
+        Write the sentences of the documents to MetaMap and read back the
+        MMI lines generated for each sentence.
+        """
+
+        self.n_markers += 1
+        batch = self.n_markers
+        framed, N = frame_metamap_input(docs, batch)
+        out = [[[] for sent in sents] for sents in docs]
+        if not N:
+            return out
+        self.proc.stdin.write(framed)
+        self.proc.stdin.flush()
+        while N:
+            line = self._readline()
+            if line.strip() == METAMAP_EOT:
+                N -= 1
+                continue
+            found = METAMAP_ID_RE.match(line)
+            if found is None or int(found.group(1)) != batch:
+                continue
+            doc, sent = int(found.group(2)), int(found.group(3))
+            if doc < len(out) and sent < len(out[doc]):
+                out[doc][sent].append(line)
+        return out
+
+
+def frame_metamap_input(docs, batch):
+    """
+    Pack the sentences of many documents into one MetaMap input, one
+    sentence per line prefixed by its id. Blank sentences are left out.
+    Input:
+        - docs: list,
+        list of lists with the ascii sentences of each document
+        - batch: int,
+        number of the batch, part of each id
+    Output:
+        - framed: str,
+        the input to be written to MetaMap
+        - N: int,
+        the number of lines in the input
+    """
+
+    parts = []
+    for i, sents in enumerate(docs):
+        for j, sent in enumerate(sents):
+            sent = ' '.join(sent.encode('utf-8').split())
+            if sent:
+                parts.append('%s|%s\n' % (METAMAP_ID % (batch, i, j), sent))
+    return ''.join(parts), len(parts)
+
+
+def parse_mmi_lines(lines):
+    """
+    Parse the fielded MMI lines MetaMap generated for a sentence. Only
+    concept (MMI) lines are kept, not abbreviations (AA).
+    Input:
+        - lines: list,
+        list of strings as generated from MetaMap with the -N flag
+    Output:
+        - records: list,
+        list of concept records as generated from mmi_record
+    """
+
+    records = []
+    for line in lines:
+        record = mmi_record(line.rstrip('\n').split('|'))
+        if record is not None:
+            records.append(record)
+    return records
+
+
+def get_metamap_process():
+    """
+    Get the MetaMap process of the current process, creating it if
+    needed. Each pool worker ends up with its own.
+    Output:
+        - MetaMapProcess instance
+    """
+
+    global _METAMAP_PROCESS
+    if _METAMAP_PROCESS is None:
+        _METAMAP_PROCESS = MetaMapProcess(max_docs=int(get_setting(['metamap', 'max_docs'], 1000)),
+                                          timeout=int(get_setting(['metamap', 'timeout'], 600)))
+        atexit.register(_METAMAP_PROCESS.close)
+    return _METAMAP_PROCESS
+
+
+def parse_semrep_lines(lines, text, renumber=False):
+    """
+    Parse the lines generated by SemRep called with the -F flag.
+    Input:
+        - lines: list,
+        list of strings as generated from SemRep
         - text: str,
-        a piece of text or sentence
+        the text that was given to SemRep
+        - renumber: bool,
+        whether to number the sentences from 1 instead of keeping
+        the sentence id SemRep printed
     Output:
         - results: dic,
         jston-style dictionary with fields text and sents. Each
@@ -430,47 +973,7 @@ def semrep_wrapper(text):
         each relation has attributes denoted in the corresponding
         mappings dictionary.
     """
-    # Exec the binary
-    # THIS SHOULD FIX ENCODING PROBLEMS???
-    text = clean_text(text)
-    utf8 = force_to_unicode(text)
-    text = unidecode(utf8)
-    # text = toAscii_wrapper(text)
-    # THIS IS NEEDED FOR ANY ARTIFACTS!
-    text = repr(text)
-    cmd = "echo " + text + " | ./semrep.v1.7 -L 2015 -Z 2015AA -F"
-    #print cmd
-    semrep_dir = settings['load']['path']['semrep']
-    lines = runProcess(cmd, semrep_dir)
-    #print(lines)
-    # mapping of line elements to fields
-    mappings = {
-        "text": {
-            "sent_id": 4,
-            "sent_text": 6
-        },
-        "entity": {
-            'cuid': 6,
-            'label': 7,
-            'sem_types': 8,
-            'score': 15
-        },
-        "relation": {
-            'subject__cui': 8,
-            'subject__label': 9,
-            'subject__sem_types': 10,
-            'subject__sem_type': 11,
-            'subject__score': 18,
-            'predicate__type': 21,
-            'predicate': 22,
-            'negation': 23,
-            'object__cui': 28,
-            'object__label': 29,
-            'object__sem_types': 30,
-            'object__sem_type': 31,
-            'object__score': 38,
-        }
-    }
+    mappings = SEMREP_MAPPINGS
     results = {'sents': [], 'text': text}
     for line in lines:
         # If Sentence
@@ -488,6 +991,8 @@ def semrep_wrapper(text):
                 tmp = {"entities": [], "relations": []}
                 for key, ind in mappings['text'].iteritems():
                     tmp[key] = elements[ind]
+                if renumber:
+                    tmp['sent_id'] = str(len(results['sents']) + 1)
                 results['sents'].append(tmp)
             # A line containing entity info
             if elements[5] == 'entity':
@@ -509,6 +1014,124 @@ def semrep_wrapper(text):
     return results
 
 
+def pack_semrep_sents(sents):
+    """
+    Pack sentences as generated from parse_semrep_lines into nested
+    tuples, dropping the repeated dictionary keys, to be sent between
+    processes.
+    Input:
+        - sents: list,
+        list of sentence dictionaries
+    Output:
+        - list of (sent_id, sent_text, entities, relations) tuples
+    """
+
+    return [(sent['sent_id'], sent['sent_text'],
+             [tuple(ent.get(k) for k in SEMREP_ENTITY_KEYS) for ent in sent['entities']],
+             [tuple(rel.get(k) for k in SEMREP_RELATION_KEYS) for rel in sent['relations']])
+            for sent in sents]
+
+
+def unpack_semrep_sents(packed):
+    """
+    Inverse of pack_semrep_sents.
+    Input:
+        - packed: list,
+        list of tuples as generated from pack_semrep_sents
+    Output:
+        - sents: list,
+        list of sentence dictionaries
+    """
+
+    return [{'sent_id': sent_id, 'sent_text': sent_text,
+             'entities': [dict(zip(SEMREP_ENTITY_KEYS, ent)) for ent in entities],
+             'relations': [dict(zip(SEMREP_RELATION_KEYS, rel)) for rel in relations]}
+            for sent_id, sent_text, entities, relations in packed]
+
+
+def semrep_wrapper(text):
+    """
+    Function wrapper for SemRep binary. It is called with flags
+    -F only and changing this will cause this parsing to fail, cause
+    the resulting lines won't have the same structure. If semrep
+    persistent is set in settings, the text is streamed through a
+    long-lived SemRep process instead of spawning a new one.
+    Input:
+        - text: str,
+        a piece of text or sentence
+    Output:
+        - results: dic,
+        jston-style dictionary with fields text and sents. Each
+        sentence has entities and relations found in it. Each entity and
+        each relation has attributes denoted in the corresponding
+        mappings dictionary.
+    """
+    # Exec the binary
+    text = prepare_semrep_text(text)
+    if str(get_setting(['semrep', 'persistent'], False)) == 'True':
+        try:
+            lines = get_semrep_process().process([text])[0]
+            return parse_semrep_lines(lines, repr(text), renumber=True)
+        except (IOError, OSError), e:
+            time_log('Falling back to a single SemRep call: %s' % e)
+    # text = toAscii_wrapper(text)
+    # THIS IS NEEDED FOR ANY ARTIFACTS!
+    text = repr(text)
+    cmd = "echo " + text + " | " + SEMREP_BIN + " " + SEMREP_FLAGS
+    #print cmd
+    semrep_dir = settings['load']['path']['semrep']
+    lines = runProcess(cmd, semrep_dir)
+    #print(lines)
+    return parse_semrep_lines(lines, text)
+
+
+def semrep_batch_wrapper(texts):
+    """
+    Function wrapper for SemRep binary, packing many texts in one
+    SemRep input and splitting the output back to each text. Uses
+    the long-lived SemRep process if semrep persistent is set.
+    Input:
+        - texts: list,
+        list of pieces of text
+    Output:
+        - results: list,
+        list of jston-style dictionaries, one for each text, as
+        generated from semrep_wrapper
+    """
+
+    texts = [prepare_semrep_text(text) for text in texts]
+    lines = None
+    if str(get_setting(['semrep', 'persistent'], False)) == 'True':
+        try:
+            lines = get_semrep_process().process(texts)
+        except (IOError, OSError), e:
+            time_log('Falling back to a single SemRep call: %s' % e)
+    if lines is None:
+        framed, _ = frame_semrep_input(texts)
+        cmd = SEMREP_BIN + " " + SEMREP_FLAGS
+        semrep_dir = settings['load']['path']['semrep']
+        lines = split_semrep_output(runProcess(cmd, semrep_dir, framed), 1, len(texts))
+    return [parse_semrep_lines(text_lines, repr(text), renumber=True)
+            for text_lines, text in zip(lines, texts)]
+
+
+def prepare_semrep_text(text):
+    """
+    Clean a piece of text and convert it to ascii, ready for SemRep.
+    Input:
+        - text: str,
+        piece of text to clean
+    Output:
+        - text: str,
+        the cleaned text
+    """
+
+    # THIS SHOULD FIX ENCODING PROBLEMS???
+    text = clean_text(text)
+    utf8 = force_to_unicode(text)
+    return unidecode(utf8)
+
+
 def clean_text(text):
     """
     Escape specific characters for command line call of SemRep. This
@@ -528,10 +1151,89 @@ def clean_text(text):
     return text
 
 
+def dedup_documents(json_):
+    """
+    Keep one document per distinct text, so that the extraction runs
+    once for each text. Texts are compared by the fingerprint of their
+    whitespace-normalized form.
+    Input:
+        - json_ : dic,
+        json-style dictionary with a field containing the documents
+    Output:
+        - json_ : dic,
+        the same dictionary with only the first document of each text
+        - slots: list,
+        one (position of the kept document, duplicate document or None,
+        fields of the kept document) tuple per original document, to
+        be given to fan_out_duplicates. None if there were no duplicates
+    """
+
+    # outerfield for the documents in json
+    docfield = settings['out']['json']['itemfield']
+    # textfield to read text from
+    textfield = settings['out']['json']['json_text_field']
+    seen = {}
+    unique = []
+    slots = []
+    for doc in json_[docfield]:
+        text = doc.get(textfield)
+        fingerprint = None
+        if isinstance(text, basestring):
+            fingerprint = text_fingerprint(' '.join(text.split()))
+        if fingerprint is not None and fingerprint in seen:
+            slots.append((seen[fingerprint], doc, None))
+        else:
+            if fingerprint is not None:
+                seen[fingerprint] = len(unique)
+            slots.append((len(unique), None, set(doc)))
+            unique.append(doc)
+    if len(unique) == len(slots):
+        return json_, None
+    json_[docfield] = unique
+    return json_, slots
+
+
+def fan_out_duplicates(json_, slots):
+    """
+    Copy the extracted fields of each kept document to its duplicates,
+    restoring the documents in their original order.
+    Input:
+        - json_ : dic,
+        json-style dictionary with the extracted unique documents
+        - slots: list,
+        as returned from dedup_documents
+    Output:
+        - json_ : dic,
+        json-style dictionary with all the documents
+    """
+
+    if slots is None:
+        return json_
+    docfield = settings['out']['json']['itemfield']
+    textfield = settings['out']['json']['json_text_field']
+    unique = json_[docfield]
+    fields = [None] * len(unique)
+    for pos, dup, before in slots:
+        if dup is None:
+            fields[pos] = (set(unique[pos]) - before) | set([textfield])
+    docs = []
+    for pos, dup, _ in slots:
+        if dup is None:
+            docs.append(unique[pos])
+            continue
+        for field in fields[pos]:
+            if field in unique[pos]:
+                dup[field] = unique[pos][field]
+        docs.append(dup)
+    json_[docfield] = docs
+    return json_
+
+
 def extract_semrep(json_, key):
     """
     Task function to parse and extract concepts from json_ style dic, using
-    the SemRep binary.
+    the SemRep binary. If semrep batch is set in settings, many documents
+    are packed in each SemRep call.
     Input:
         - json_ : dic,
         json-style dictionary generated from the Parse object related
@@ -550,23 +1252,15 @@ def extract_semrep(json_, key):
     # textfield to read text from
     textfield = settings['out']['json']['json_text_field']
     N = len(json_[docfield])
+    cache = get_sentence_cache(SEMREP_BIN + ' ' + SEMREP_FLAGS)
+    if cache is not None:
+        return extract_semrep_cached(json_, docfield, textfield, cache)
+    if str(get_setting(['semrep', 'batch'], False)) == 'True':
+        return extract_semrep_batches(json_, docfield, textfield)
     for i, doc in enumerate(json_[docfield]):
         print doc['id']
         text = doc[textfield]
-        if len(text) > 5000:
-            chunks = create_text_batches(text)
-            results = {'text': text, 'sents': []}
-            sent_id = 0
-            c = 0
-            for chunk in chunks:
-                c += 1
-                tmp = semrep_wrapper(chunk)
-                for sent in tmp['sents']:
-                    sent['sent_id'] = sent_id
-                    sent_id += 1
-                    results['sents'].append(sent)
-        else:
-            results = semrep_wrapper(text)
+        results = assemble_semrep_units(text, [semrep_wrapper(unit) for unit in semrep_text_units(text)])
         json_[docfield][i].update(results)
         proc = int(i/float(N)*100)
         if proc % 10 == 0 and proc > 0:
@@ -574,12 +1268,268 @@ def extract_semrep(json_, key):
     return json_
 
 
+def extract_semrep_batches(json_, docfield, textfield):
+    """
+    Batching mode of extract_semrep. The texts (or 5000-char chunks)
+    of the documents are packed into SemRep inputs of at most
+    semrep batch_docs texts and semrep batch_chars characters.
+    Input:
+        - json_ : dic,
+        json-style dictionary generated from the Parse object related
+        to the specific type of input
+        - docfield: str,
+        field where the documents are found
+        - textfield: str,
+        field where the text of each document is found
+    Output:
+        - json_ : dic,
+        the previous json-style dictionary enriched with medical concepts
+    """
+
+    N = len(json_[docfield])
+    max_docs = int(get_setting(['semrep', 'batch_docs'], 200))
+    max_chars = int(get_setting(['semrep', 'batch_chars'], 200000))
+    units = []
+    owners = []
+    for i, doc in enumerate(json_[docfield]):
+        for unit in semrep_text_units(doc[textfield]):
+            units.append(unit)
+            owners.append(i)
+    batches = create_semrep_batches(units, max_docs, max_chars)
+    unit_results = []
+    for j, batch in enumerate(batches):
+        unit_results.extend(semrep_batch_wrapper([units[ind] for ind in batch]))
+        time_log('Completed SemRep batch %d/%d with %d texts' % (j + 1, len(batches), len(batch)))
+    doc_results = [[] for i in xrange(N)]
+    for owner, results in zip(owners, unit_results):
+        doc_results[owner].append(results)
+    for i, doc in enumerate(json_[docfield]):
+        doc.update(assemble_semrep_units(doc[textfield], doc_results[i]))
+    return json_
+
+
+def extract_semrep_cached(json_, docfield, textfield, cache):
+    """
+    Cached mode of extract_semrep. Each cleaned text is broken into
+    sentences and only the sentences missing from the sentence cache
+    are sent to SemRep. The missing sentences of a document are sent
+    together (see cache_miss_units), packed in batches as in
+    extract_semrep_batches, and the output is split back to each of
+    them by their offsets. The documents are then assembled from copies
+    of the cached sentences.
+    Input:
+        - json_ : dic,
+        json-style dictionary generated from the Parse object related
+        to the specific type of input
+        - docfield: str,
+        field where the documents are found
+        - textfield: str,
+        field where the text of each document is found
+        - cache: SentenceCache,
+        the cache to read from and update
+    Output:
+        - json_ : dic,
+        the previous json-style dictionary enriched with medical concepts
+    """
+
+    max_docs = int(get_setting(['semrep', 'batch_docs'], 200))
+    max_chars = int(get_setting(['semrep', 'batch_chars'], 200000))
+    doc_sents = []
+    for doc in json_[docfield]:
+        text = prepare_semrep_text(doc[textfield])
+        sents = [' '.join(sent.split()) for sent in sent_tokenize(text)]
+        doc_sents.append((text, [cache.key(sent) for sent in sents], sents))
+    found = cache.get_many([key for _, keys, _ in doc_sents for key in keys])
+    units = cache_miss_units([(keys, sents) for _, keys, sents in doc_sents], found)
+    if units:
+        unit_texts = [' '.join(sents) for _, sents in units]
+        new = {}
+        for batch in create_semrep_batches(unit_texts, max_docs, max_chars):
+            batch_results = semrep_batch_wrapper([unit_texts[ind] for ind in batch])
+            for ind, results in zip(batch, batch_results):
+                for sent in results['sents']:
+                    del sent['sent_id']
+                keys, sents = units[ind]
+                new.update(zip(keys, split_semrep_sents(results['sents'], sents)))
+        cache.put_many(new)
+        found.update(new)
+    for doc, (text, keys, _) in zip(json_[docfield], doc_sents):
+        results = {'text': repr(text), 'sents': []}
+        for key in keys:
+            # Sentences repeated across documents must not share lists
+            for sent in copy.deepcopy(found[key]):
+                sent['sent_id'] = str(len(results['sents']) + 1)
+                results['sents'].append(sent)
+        doc.update(assemble_semrep_units(doc[textfield], [results]))
+    cache.report()
+    return json_
+
+
+def cache_miss_units(doc_sents, found, N=5000):
+    """
+    Helper function to group the sentences missing from the sentence
+    cache in the pieces of text sent to SemRep. The missing sentences
+    of each document are kept together, in their order, so that SemRep
+    sees as much of the context of the document as possible, in pieces
+    of at most N chars. Sentences repeated across documents are sent once.
+    Input:
+        - doc_sents: list,
+        list of (keys, sentences) tuples, one for each document
+        - found: dic,
+        the keys found in the cache
+        - N: int,
+        maximum length of text given to SemRep at once
+    Output:
+        - units: list,
+        list of (keys, sentences) tuples, one for each piece of text
+    """
+
+    units = []
+    seen = set()
+    for keys, sents in doc_sents:
+        unit = ([], [])
+        size = 0
+        for key, text in zip(keys, sents):
+            if key in found or key in seen:
+                continue
+            seen.add(key)
+            if unit[0] and size + len(text) > N:
+                units.append(unit)
+                unit = ([], [])
+                size = 0
+            unit[0].append(key)
+            unit[1].append(text)
+            size += len(text) + 1
+        if unit[0]:
+            units.append(unit)
+    return units
+
+
+def split_semrep_sents(results, sents):
+    """
+    Helper function to split the sentences SemRep found in a piece of
+    text generated from cache_miss_units back to the sentences of the
+    piece. Each SemRep sentence is located in the text and given to the
+    sentence it starts in, as SemRep may break the text differently.
+    Input:
+        - results: list,
+        list of the sentence dictionaries SemRep generated
+        - sents: list,
+        list of the sentences joined to the piece of text
+    Output:
+        - out: list,
+        list of lists with the sentence dictionaries of each sentence
+    """
+
+    text = ' '.join(sents)
+    starts = []
+    pos = 0
+    for sent in sents:
+        starts.append(pos)
+        pos += len(sent) + 1
+    out = [[] for sent in sents]
+    start = 0
+    end = 0
+    for sent in results:
+        sent_text = ' '.join(sent.get('sent_text', '').split())
+        found = text.find(sent_text, end)
+        # Unknown sentences go with the previous one
+        if found >= 0:
+            start = found
+            end = found + len(sent_text)
+        out[max(bisect.bisect_right(starts, start) - 1, 0)].append(sent)
+    return out
+
+
+def semrep_text_units(text, N=5000):
+    """
+    Helper function returning the pieces of a text that SemRep
+    is called on. Texts longer than N chars are broken with
+    create_text_batches.
+    Input:
+        - text: str,
+        the text of a document
+        - N: int,
+        maximum length of text given to SemRep at once
+    Output:
+        - list of strings
+    """
+
+    if len(text) > N:
+        return create_text_batches(text, N)
+    return [text]
+
+
+def assemble_semrep_units(text, unit_results, N=5000):
+    """
+    Helper function to assemble the SemRep results of the pieces
+    generated from semrep_text_units back to one document. The
+    sentences of chunked texts are renumbered starting from 0.
+    Input:
+        - text: str,
+        the text of the document
+        - unit_results: list,
+        list of the semrep_wrapper results of each piece
+        - N: int,
+        maximum length of text given to SemRep at once
+    Output:
+        - results: dic,
+        json-style dictionary with fields text and sents
+    """
+
+    if len(text) <= N:
+        return unit_results[0]
+    results = {'text': text, 'sents': []}
+    sent_id = 0
+    for tmp in unit_results:
+        for sent in tmp['sents']:
+            sent['sent_id'] = sent_id
+            sent_id += 1
+            results['sents'].append(sent)
+    return results
+
+
+def create_semrep_batches(texts, max_docs, max_chars):
+    """
+    Helper function to group consecutive texts in batches of at
+    most max_docs texts and max_chars characters. A text longer than
+    max_chars is given its own batch.
+    Input:
+        - texts: list,
+        list of strings
+        - max_docs: int,
+        maximum number of texts in a batch
+        - max_chars: int,
+        maximum number of characters in a batch
+    Output:
+        - batches: list,
+        list of lists with the indices of the texts in each batch
+    """
+
+    batches = []
+    current = []
+    chars = 0
+    for i, text in enumerate(texts):
+        if current and (len(current) >= max_docs or chars + len(text) > max_chars):
+            batches.append(current)
+            current = []
+            chars = 0
+        current.append(i)
+        chars += len(text)
+    if current:
+        batches.append(current)
+    return batches
+
+
 
 
 def extract_semrep_parallel(json_, key):
     """
     Task function to parse and extract concepts from json_ style dic, using
-    the SemRep binary. It uses multiprocessing for efficiency.
+    the SemRep binary. It uses multiprocessing for efficiency. Documents
+    are sorted longest-first and grouped in small tasks of at most semrep
+    task_docs documents and task_chars characters, which are handed to
+    the workers as soon as they are free.
     Input:
         - json_ : dic,
         json-style dictionary generated from the Parse object related
@@ -593,33 +1543,201 @@ def extract_semrep_parallel(json_, key):
     """
     # outerfield for the documents in json
     docfield = settings['out']['json']['itemfield']
+    # textfield to read text from
+    textfield = settings['out']['json']['json_text_field']
     N = len(json_[docfield])
-    try:
-        N_THREADS = int(settings['num_cores'])
-    except:
-        N_THREADS = cpu_count()
-    batches = chunk_document_collection(json_[docfield], N_THREADS)
-    len_col = " | ".join([str(len(b)) for b in batches])
-    time_log('Will break the collection into batches of: %s documents!' % len_col)
-    batches = [{docfield: batch} for batch in batches]
-    data = zip(batches, [key for batch in batches])
-    pool = Pool(N_THREADS, maxtasksperchild=1)
-    res = pool.map(semrep_parallel_worker, data)
-    pool.close()
-    pool.join()
-    del pool
-    tmp = {docfield: []}
-    for batch_res in res:
-        tmp[docfield].extend(batch_res[docfield])
-    for i, sub_doc in enumerate(json_[docfield]):
-        for sub_doc_new in tmp[docfield]:
-            if sub_doc_new['id'] == sub_doc['id']:
-                json_[docfield][i].update(sub_doc_new)
-                break
+    N_THREADS = get_num_workers()
+    max_docs = int(get_setting(['semrep', 'task_docs'], 10))
+    max_chars = int(get_setting(['semrep', 'task_chars'], 20000))
+    # Longest documents first, so that the batch ends close to total_work / cores
+    texts = [doc.get(textfield) or '' for doc in json_[docfield]]
+    order = sorted(xrange(N), key=lambda i: len(texts[i]), reverse=True)
+    groups = create_semrep_batches([texts[i] for i in order], max_docs, max_chars)
+    time_log('Will break the collection into %d tasks of at most %d documents!' % (len(groups), max_docs))
+    # Each task carries only the position, id and text of its documents
+    idfield = settings['out']['json']['json_id_field']
+    data = [(key, [(order[ind], json_[docfield][order[ind]].get(idfield), texts[order[ind]])
+                   for ind in group]) for group in groups]
+    res = run_dynamic_tasks(get_pool(), semrep_parallel_worker, data, N_THREADS)
+    for packed in res:
+        for pos, text, sents in unpack_payload(packed):
+            json_[docfield][pos].update({'text': text, 'sents': unpack_semrep_sents(sents)})
+    if str(get_setting(['log_ipc'], False)) == 'True':
+        # What the whole documents would cost to send back and forth
+        full_in = pickled_size([({docfield: [json_[docfield][order[ind]] for ind in group]}, key)
+                                for group in groups])
+        log_ipc_sizes('SemRep', full_in, pickled_size(json_[docfield]),
+                      pickled_size(data), pickled_size(res))
     time_log('Completed multiprocessing extraction!')
     return json_
 
 
+def extract_metamap_parallel(json_, key):
+    """
+    Task function to parse and extract concepts from json_ style dic, using
+    the MetaMap binary. It uses multiprocessing for efficiency. The texts
+    are broken into the 5000-char chunks MetaMap is called on, which are
+    sorted longest-first and grouped in small tasks of at most metamap
+    task_docs chunks and task_chars characters, handed to the workers as
+    soon as they are free. The chunks of each document are assembled back
+    after all tasks complete.
+    Input:
+        - json_ : dic,
+        json-style dictionary generated from the Parse object related
+        to the specific type of input
+        - key : str,
+        string denoting the type of medical text to read from. Used to
+        find the correct paragraph in the settings.yaml file.
+    Output:
+        - json_ : dic,
+        the previous json-style dictionary enriched with medical concepts
+    """
+    # outerfield for the documents in json
+    docfield = settings['out']['json']['itemfield']
+    # textfield to read text from
+    textfield = settings['out']['json']['json_text_field']
+    N = len(json_[docfield])
+    N_THREADS = get_num_workers()
+    max_docs = int(get_setting(['metamap', 'task_docs'], 10))
+    max_chars = int(get_setting(['metamap', 'task_chars'], 20000))
+    texts = [clean_text(doc[textfield]) for doc in json_[docfield]]
+    units = []
+    owners = []
+    for i, text in enumerate(texts):
+        for unit in semrep_text_units(text):
+            units.append(unit)
+            owners.append(i)
+    # Longest chunks first, so that the batch ends close to total_work / cores
+    order = sorted(xrange(len(units)), key=lambda j: len(units[j]), reverse=True)
+    groups = create_semrep_batches([units[j] for j in order], max_docs, max_chars)
+    time_log('Will break the %d documents into %d chunks and %d tasks of at most %d chunks!' %
+             (N, len(units), len(groups), max_docs))
+    # Each task carries only the position and text of its chunks
+    data = [(key, [(order[ind], units[order[ind]]) for ind in group]) for group in groups]
+    res = run_dynamic_tasks(get_pool(), metamap_parallel_worker, data, N_THREADS)
+    unit_results = [None] * len(units)
+    for packed in res:
+        for pos, sent_records in unpack_payload(packed):
+            unit_results[pos] = {'sents': metamap_sentences(sent_records), 'sent_text': units[pos]}
+    doc_results = [[] for i in xrange(N)]
+    for owner, results in zip(owners, unit_results):
+        doc_results[owner].append(results)
+    for i, doc in enumerate(json_[docfield]):
+        doc.update(assemble_semrep_units(texts[i], doc_results[i]))
+    if str(get_setting(['log_ipc'], False)) == 'True':
+        # What the whole documents would cost to send back and forth
+        full_in = pickled_size([(key, [json_[docfield][i] for i in sorted(set(owners[order[ind]] for ind in group))])
+                                for group in groups])
+        log_ipc_sizes('MetaMap', full_in, pickled_size(json_[docfield]),
+                      pickled_size(data), pickled_size(res))
+    time_log('Completed multiprocessing extraction!')
+    return json_
+
+
+def metamap_parallel_worker((key, items)):
+    """
+    Just a worker interface for the MetaMap executions. Receives only
+    the position and text of each chunk and sends back only the concept
+    records of its sentences, packed with pack_payload.
+    Input:
+        - key : str,
+        string denoting the type of medical text to read from.
+        - items: list,
+        list of (position, text) tuples
+    Output:
+        - res : str,
+        packed list of (position, sent_records) tuples, where sent_records
+        holds the records (see mmi_record) of the concepts of each sentence
+    """
+
+    results = metamap_batch_wrapper([text for _, text in items])
+    return pack_payload([(pos, [[tuple(ent[k] for k in METAMAP_ENTITY_KEYS) for ent in sent['entities']]
+                                for sent in tmp['sents']])
+                         for (pos, _), tmp in zip(items, results)])
+
+
+def run_dynamic_tasks(pool, worker, tasks, num):
+    """
+    Helper function to run tasks on a pool, handing each task to the
+    first free worker instead of splitting them beforehand. Progress is
+    logged as tasks complete and the utilisation of each worker is
+    logged at the end.
+    Input:
+        - pool: multiprocessing.Pool,
+        the pool of workers
+        - worker: function,
+        module-level function to be called on each task
+        - tasks: list,
+        list of arguments for the worker, in the order to be submitted
+        - num: int,
+        number of workers in the pool
+    Output:
+        - results: list,
+        list of the worker results, in order of completion
+    """
+
+    time_start = time.time()
+    results = []
+    busy = {}
+    done = {}
+    N = len(tasks)
+    last_proc = 0
+    timed = [(worker, task) for task in tasks]
+    for i, (pid, elapsed, res) in enumerate(pool.imap_unordered(timed_worker, timed)):
+        results.append(res)
+        busy[pid] = busy.get(pid, 0) + elapsed
+        done[pid] = done.get(pid, 0) + 1
+        proc = int((i + 1) / float(N) * 100)
+        if proc // 10 > last_proc // 10:
+            time_log('We are at %d/%d tasks -- %0.2f %%' % (i + 1, N, proc))
+        last_proc = proc
+    log_worker_utilisation(busy, done, time.time() - time_start, num)
+    return results
+
+
+def timed_worker((worker, task)):
+    """
+    Worker interface timing the execution of a task.
+    Input:
+        - worker: function,
+        the function to be called on the task
+        - task: tuple,
+        the arguments of the worker
+    Output:
+        - pid: int, the process id of the worker
+        - elapsed: float, seconds spent on the task
+        - res: the result of the worker
+    """
+
+    time_start = time.time()
+    res = worker(task)
+    return os.getpid(), time.time() - time_start, res
+
+
+def log_worker_utilisation(busy, done, wall, num):
+    """
+    Log how busy each worker was during a batch.
+    Input:
+        - busy: dic,
+        seconds of work done by each worker pid
+        - done: dic,
+        number of tasks completed by each worker pid
+        - wall: float,
+        seconds the whole batch took
+        - num: int,
+        number of workers in the pool
+    """
+
+    if wall <= 0:
+        return
+    for pid in sorted(busy):
+        time_log('Worker %d: %d tasks in %.2f seconds -- %0.2f %% utilisation' %
+                 (pid, done[pid], busy[pid], 100 * busy[pid] / wall))
+    total = sum(busy.values())
+    time_log('Batch took %.2f seconds. Ideal (total work / cores): %.2f seconds -- %0.2f %% utilisation' %
+             (wall, total / num, 100 * total / (wall * num)))
+
+
 def chunk_document_collection(seq, num):
     """
     Helper function to break a collection of N = len(seq) documents
@@ -646,24 +1764,31 @@ def chunk_document_collection(seq, num):
     return out
 
 
-def semrep_parallel_worker((json_, key)):
+def semrep_parallel_worker((key, items)):
     """
     Just a worker interface for the different SemRep
-    executions.
+    executions. Receives only the position, id and text of each
+    document and sends back only the fields generated from the
+    extraction, packed with pack_payload.
     Input:
-        - json_ : dic,
-        json-style dictionary generated from the Parse object related
-        to the specific type of input
         - key : str,
         string denoting the type of medical text to read from. Used to
         find the correct paragraph in the settings.yaml file.
+        - items: list,
+        list of (position, id, text) tuples
     Output:
-        - res : dic,
-        the previous json-style dictionary enriched with medical concepts
+        - res : str,
+        packed list of (position, text, sents) tuples, where sents are
+        packed with pack_semrep_sents
 
     """
+    docfield = settings['out']['json']['itemfield']
+    textfield = settings['out']['json']['json_text_field']
+    idfield = settings['out']['json']['json_id_field']
+    json_ = {docfield: [{idfield: doc_id, textfield: text} for _, doc_id, text in items]}
     res = extract_semrep(json_, key)
-    return res
+    return pack_payload([(pos, doc['text'], pack_semrep_sents(doc['sents']))
+                         for (pos, _, _), doc in zip(items, res[docfield])])
 
 
 
@@ -687,47 +1812,47 @@ def get_concepts_from_edges_parallel(json_, key):
     """
     outfield = settings['load'][key]['itemfield']
     N = len(json_[outfield])
-    try:
-        N_THREADS = int(settings['num_cores'])
-    except:
-        N_THREADS = cpu_count()
+    N_THREADS = get_num_workers()
     batches = chunk_document_collection(json_[outfield], N_THREADS)
     len_col = " | ".join([str(len(b)) for b in batches])
     time_log('Will break the edges into batches of: %s documents!' % len_col)
-    batches = [{outfield: batch} for batch in batches]
-    data = zip(batches, [key for batch in batches])
-    pool = Pool(N_THREADS, maxtasksperchild=1)
-    res = pool.map(edges_parallel_worker, data)
-    pool.close()
-    pool.join()
-    del pool
+    # Only the subject, predicate and object of each edge are sent
+    data = [(key, [(triple['s'], triple['p'], triple['o']) for triple in batch]) for batch in batches]
+    res = get_pool().map(edges_parallel_worker, data)
+    if str(get_setting(['log_ipc'], False)) == 'True':
+        full_in = pickled_size([({outfield: batch}, key) for batch in batches])
     json_ = {outfield: []}
-    for batch_res in res:
-        json_[outfield].extend(batch_res[outfield])
+    for packed in res:
+        json_[outfield].extend([{'s': s, 'p': p, 'o': o} for s, p, o in unpack_payload(packed)])
+    if str(get_setting(['log_ipc'], False)) == 'True':
+        log_ipc_sizes('Edges', full_in, pickled_size(json_), pickled_size(data), pickled_size(res))
     time_log('Completed multiprocessing extraction!')
     return json_
 
 
 
 
-def edges_parallel_worker((json_, key)):
+def edges_parallel_worker((key, triples)):
     """
     Just a worker interface for the parallel enrichment
-    executions.
+    executions. Receives and sends back only the subject,
+    predicate and object of each edge.
     Input:
-        - json_ : dic,
-        json-style dictionary generated from the Parse object related
-        to the specific type of input
         - key : str,
         string denoting the type of medical text to read from. Used to
         find the correct paragraph in the settings.yaml file.
+        - triples: list,
+        list of (s, p, o) tuples
     Output:
-        - res : dic,
-        expected outcome of get_concepts_from_edges
+        - res : str,
+        packed list of (s, p, o) tuples of the outcome of
+        get_concepts_from_edges
 
     """
+    outfield = settings['load'][key]['itemfield']
+    json_ = {outfield: [{'s': s, 'p': p, 'o': o} for s, p, o in triples]}
     res = get_concepts_from_edges(json_, key)
-    return res
+    return pack_payload([(rel['s'], rel['p'], rel['o']) for rel in res[outfield]])
 
 
 def get_concepts_from_edges(json_, key):
@@ -766,7 +1891,7 @@ def get_concepts_from_edges(json_, key):
     uri = settings['load']['mongo']['uri']
     db_name = settings['load']['mongo']['db']
     collection_name = settings['load']['mongo']['cache_collection']
-    client = pymongo.MongoClient(uri)
+    client = get_mongo_client(uri)
     db = client[db_name]
     collection = db[collection_name]
     cur = collection.find({})
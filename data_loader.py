@@ -5,15 +5,33 @@
 # Functions to extract knowledge from medical text. Everything related to 
 # reading and parsing.
 
+import os
+import re
+import glob
+import gzip
 import json
+import mmap
+import hashlib
+import threading
 import py2neo
 import pymongo
+from bson import ObjectId
 import langid
 import pandas as pd
-from config import settings
+from config import settings, get_setting
 from utilities import time_log
+from extraction_store import get_extraction_store
+from workers import get_mongo_client, get_pool, get_num_workers
+from json_stream import JsonArrayIndex, LazyRecord, read_index_header, write_index_file
 from multiprocessing import cpu_count
-import ijson.backends.yajl2_cffi as ijson2
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Memoized languages of text prefixes, keyed by their hash
+_LANGUAGES = {}
 
 
 def load_mongo(key):
@@ -38,158 +56,910 @@ def load_mongo(key):
     # itemfield containing list of elements
     out_outfield = settings['out']['json']['itemfield']
     json_ = {out_outfield: []}
-    cur = collection.find({})
+    cur = collection.find({}, projection=get_projection(key))
     for item in cur:
         del item['_id']
         json_[out_outfield].append(item)
     return json_
 
 
-def load_mongo_batches(key, N_collection, ind_=0):
+def load_mongo_batches(key, N_collection, ind_=None):
     """
     Parse collection from mongo to be processed in streaming/parallel fashion.
-    Fetches step = (N X numb_cores) of documents starting from ind_ and
-    delivers it to the rest of the pipeline.
+    Fetches step = (N X numb_cores) of documents with _id greater than the
+    last one read, sorted by _id, so that mongo uses the _id index instead
+    of walking past all the previous documents. If batch_chars is set, the
+    batch stops at the document whose text reaches that many characters.
     Input:
         - key: str,
         the type of input to read
         - N_collection: int,
-        total collection length
-        - ind: int,
-        the starting point of the batch (or stream) to be read
+        total collection length, for logging. 'unknown' while
+        still being counted
+        - ind_: ObjectId,
+        the last _id read (resume token). None to start from the beginning
     Output:
         - json_ : dic,
         json-style dictionary with a field containing
         items
+        - last_id: ObjectId,
+        the _id of the last item read, to continue from. None if the
+        collection was exhausted
     """
     # input file path from settings.yaml
     uri = settings['load']['mongo']['uri']
     db_name = settings['load']['mongo']['db']
     collection_name = settings['load']['mongo']['collection']
-    client = pymongo.MongoClient(uri)
+    client = get_mongo_client(uri)
     db = client[db_name]
     collection = db[collection_name]
     # itemfield containing list of elements
     out_outfield = settings['out']['json']['itemfield']
     json_ = {out_outfield: []}
-    stream_flag = str(settings['pipeline']['in']['stream']) == 'True'
-    # batch size in case of streaming enviroment is just one
-    if stream_flag:
-        step = 1
-    # else N_THREADS*
-    else:
-        try:
-            N_THREADS = int(settings['num_cores'])
-        except:
-            N_THREADS = cpu_count()
-        try:
-            batch_per_core = int(settings['batch_per_core'])
-        except:
-            batch_per_core = 100
-        step = N_THREADS * batch_per_core
-    time_log("Will start from %d/%d and read %d items" % (ind_, N_collection, step))
-    if step > N_collection:
-        step = N_collection
-    else:
-        cur = collection.find({}, skip=ind_, limit=step)
-        c = 0
-        for item in cur:
-            del item['_id']
-            c += 1
-            json_[out_outfield].append(item)
-        return json_, ind_ + step
+    step = get_batch_step()
+    time_log("Will start after _id %s and read %d items out of %s" % (ind_, step, N_collection))
+    query = {}
+    if ind_ is not None:
+        query = {'_id': {'$gt': ind_}}
+    cur = collection.find(query, projection=get_projection(key),
+                          sort=[('_id', pymongo.ASCENDING)], limit=step)
+    budget = get_batch_chars()
+    textfield = settings['load'].get(key, {}).get('textfield')
+    chars = 0
+    last_id = None
+    for item in cur:
+        last_id = item.pop('_id')
+        json_[out_outfield].append(item)
+        if budget is not None:
+            chars += len(item.get(textfield) or '')
+            if chars >= budget:
+                break
+    if hasattr(cur, 'close'):
+        cur.close()
+    if last_id is None:
+        return None, None
+    # The last _id is returned even for a short batch, as it's the
+    # watermark of the incremental mode. The next read comes back empty
+    return json_, last_id
+
+
+# Resume token of an ObjectId _id (see mongo_id_token)
+MONGO_OBJECTID_RE = re.compile(r'^ObjectId\(([0-9a-fA-F]{24})\)$')
+
+
+def get_mongo_resume_token():
+    """
+    Helper function to get the _id to resume reading the mongo
+    collection after, as logged from a previous run. It is read from
+    resume_from in the mongo load settings.
+    Output:
+        - ObjectId or None to start from the beginning
+    """
+
+    return to_mongo_id(get_setting(['load', 'mongo', 'resume_from'], None))
+
+
+def mongo_id_token(_id):
+    """
+    Helper function to turn an _id into a resume token that can be
+    logged or saved as json, keeping its type: an ObjectId becomes
+    'ObjectId(<hex>)', while other _id values are kept as they are, so
+    that string _ids that look like ObjectIds are not converted back.
+    Input:
+        - _id: ObjectId or other _id value
+    Output:
+        - the token
+    """
+
+    if isinstance(_id, ObjectId):
+        return 'ObjectId(%s)' % _id
+    return _id
+
+
+def to_mongo_id(token):
+    """
+    Helper function to turn a resume token generated from mongo_id_token
+    back to the _id. Only tokens saved as 'ObjectId(<hex>)' become
+    ObjectIds, other _id values are returned as they are.
+    Input:
+        - token: str or other _id value
+    Output:
+        - the _id or None if missing
+    """
+
+    if token is None or str(token) == 'None':
+        return None
+    if isinstance(token, basestring):
+        found = MONGO_OBJECTID_RE.match(token)
+        if found is not None:
+            return ObjectId(found.group(1))
+    return token
+
 
-def load_file(key):
+def load_file(key, inp_path=None):
     """
     Parse file containing items.
     Input:
         - key: str,
         the type of input to read
+        - inp_path: str,
+        path to the file. Defaults to the file_path in settings
     Output:
         - json_ : dic,
         json-style dictionary with items
     """
 
     # input file path from settings.yamml
+    if inp_path is None:
+        inp_path = settings['load']['path']['file_path']
     if key == 'med_rec':
-        json_ = parse_medical_rec()
+        json_ = parse_medical_rec(inp_path)
+    elif get_file_format(inp_path) == 'jsonl':
+        infield = settings['load'][key]['itemfield']
+        fields = get_projection(key)
+        f = open_input_file(inp_path)
+        try:
+            json_ = {infield: decode_json_lines((iter_lines(f), fields))}
+        finally:
+            f.close()
+    elif use_lazy_records():
+        # Only the items are kept, as raw records
+        infield = settings['load'][key]['itemfield']
+        reader = FileBatchReader(inp_path, infield, get_projection(key))
+        try:
+            json_ = {infield: reader.read(0, len(reader))}
+        finally:
+            reader.close()
     else:
-        inp_path = settings['load']['path']['file_path']
         with open(inp_path, 'r') as f:
             json_ = json.load(f, encoding='utf-8')
+        fields = get_projection(key)
+        if fields is not None:
+            infield = settings['load'][key]['itemfield']
+            json_[infield] = [project_fields(item, fields) for item in json_[infield]]
     return json_
 
 
-def load_file_batches(key, N_collection, ind_=0):
+class FileBatchReader(object):
+    """
+    Reader of the items of a json file, to be kept alive across batches.
+    The file is memory-mapped and the byte spans of the items of the
+    itemfield array are taken from its sidecar index (see get_file_index),
+    so any batch is found in O(1) and only its own items are decoded.
+    The byte offset of the next item to read is used as the batch token,
+    which can also resume a later run. If lazy_records is set in the path
+    load settings, items are not decoded but kept as LazyRecord.
+    """
+
+    def __init__(self, path, itemfield, fields=None):
+        """
+        Initialization of the class.
+        Attributes:
+            - path: str, path to the json file
+            - itemfield: str, outer field of the array of items
+            - fields: list, the fields of the items to keep (see
+            get_projection). None to keep whole items
+        """
+
+        self.path = path
+        self.itemfield = itemfield
+        self.fields = fields
+        self.lazy = use_lazy_records()
+        self.file = open(path, 'rb')
+        if os.fstat(self.file.fileno()).st_size:
+            self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.buf = ''
+        self.index = get_file_index(path, itemfield, self.buf)
+        if not len(self.index):
+            time_log('No %s items found in %s' % (itemfield, path))
+
+    def __len__(self):
+        return len(self.index)
+
+    def count(self, start=None):
+        """
+        Number of items from the byte offset start to the end of the array.
+        """
+
+        return len(self.index) - self.index.locate(start)
+
+    def read(self, start, stop):
+        """
+        Decode the items with positions in [start, stop). If parallel_decode
+        is set in the path load settings, the byte ranges are split between
+        the workers of the pool.
+        Input:
+            - start: int,
+            position of the first item
+            - stop: int,
+            position after the last item
+        Output:
+            - items: list,
+            list of decoded items
+        """
+
+        starts = self.index.starts[start:stop].tolist()
+        ends = self.index.ends[start:stop].tolist()
+        if self.lazy:
+            return [LazyRecord(self.buf[s:e], self.fields) for s, e in zip(starts, ends)]
+        parallel = str(get_setting(['load', 'path', 'parallel_decode'], False)) == 'True'
+        N_THREADS = get_num_workers()
+        if not(parallel) or len(starts) < 2 * N_THREADS:
+            return [project_fields(json.loads(self.buf[s:e]), self.fields)
+                    for s, e in zip(starts, ends)]
+        chunk = len(starts) // N_THREADS + 1
+        tasks = [(self.path, zip(starts[i:i + chunk], ends[i:i + chunk]), self.fields)
+                 for i in xrange(0, len(starts), chunk)]
+        items = []
+        for part in get_pool().map(decode_json_range, tasks):
+            items.extend(part)
+        return items
+
+    def load_batch(self, key, N_collection, ind_=None):
+        """
+        Parse collection from file to be processed in streaming/parallel
+        fashion. Fetches step = (N X numb_cores) of documents starting from
+        the byte offset ind_ and delivers it to the rest of the pipeline.
+        If batch_chars is set, the batch stops at the item whose raw size
+        reaches that many characters.
+        Input:
+            - key: str,
+            the type of input to read
+            - N_collection: int,
+            total collection length, for logging. 'unknown' while
+            still being counted
+            - ind_: int,
+            byte offset to start from, as returned from the previous batch.
+            None to start from the first item
+        Output:
+            - json_ : dic,
+            json-style dictionary with a field containing
+            items
+            - offset: int,
+            byte offset to continue from. None if the file was exhausted
+        """
+
+        # itemfield containing list of elements
+        out_outfield = settings['out']['json']['itemfield']
+        step = get_batch_step()
+        start = self.index.locate(ind_)
+        stop = min(start + step, len(self.index))
+        if start >= stop:
+            return None, None
+        budget = get_batch_chars()
+        if budget is not None:
+            # The raw size of the items stands for their length
+            sizes = (self.index.ends[start:stop] - self.index.starts[start:stop]).tolist()
+            stop = start + cut_by_chars(sizes, budget)
+        time_log("Will start from %d/%s and read %d items" % (start, N_collection, stop - start))
+        items = self.read(start, stop)
+        return {out_outfield: items}, self.index.offset_of(stop)
+
+    def close(self):
+        if self.buf:
+            self.buf.close()
+        self.file.close()
+
+
+def decode_json_range((path, spans, fields)):
+    """
+    Worker function decoding a contiguous range of items of a json file.
+    Input:
+        - path: str,
+        path to the json file
+        - spans: list,
+        list of (start, end) byte offsets of the items
+        - fields: list,
+        the fields of the items to keep. None to keep whole items
+    Output:
+        - items: list,
+        list of decoded items
+    """
+
+    base = spans[0][0]
+    with open(path, 'rb') as f:
+        f.seek(base)
+        data = f.read(spans[-1][1] - base)
+    return [project_fields(json.loads(data[s - base:e - base]), fields) for s, e in spans]
+
+
+def get_projection(key):
+    """
+    Helper function to find the fields of the input documents the
+    configured pipeline needs, so that only those are fetched from
+    mongo or kept when decoding a file: the text, id and label fields
+    and the metadata_fields of the load settings of key. Whole documents are needed
+    when reading edges, when saving the documents themselves (json
+    and mongo outputs) and when the extraction store is used.
+    Input:
+        - key: str,
+        the type of input to read
+    Output:
+        - fields: list,
+        the fields to keep. None if whole documents are needed
+    """
+
+    if not(key in ['text', 'med_rec']):
+        return None
+    out = settings['pipeline']['out']
+    if str(out.get('json')) == 'True' or str(out.get('mongo')) == 'True':
+        return None
+    store_path = get_setting(['store', 'path'], None)
+    if store_path and str(store_path) != 'None':
+        return None
+    fields = [settings['load'][key]['textfield'],
+              settings['load'][key]['idfield']]
+    if key == 'text' and settings['load']['text']['labelfield'] != 'None':
+        fields.append(settings['load']['text']['labelfield'])
+    metadata = get_setting(['load', key, 'metadata_fields'], None)
+    if metadata and str(metadata) != 'None':
+        fields.extend(metadata)
+    return fields
+
+
+def project_fields(item, fields):
+    """
+    Keep only the given fields of a decoded item.
+    Input:
+        - item: dic,
+        the decoded item
+        - fields: list,
+        the fields to keep. None to keep the whole item
+    Output:
+        - dic, the projected item
+    """
+
+    if fields is None:
+        return item
+    return dict((field, item[field]) for field in fields if field in item)
+
+
+def get_index_path(path):
+    """
+    Helper function to get the sidecar index file of a json file. Read
+    from index_path in the path load settings: a file is used for the
+    file_path itself, while shards get their own path plus .index, and
+    a directory keeps the index of every file under its name.
+    Input:
+        - path: str,
+        path to the json file
+    Output:
+        - index_path: str,
+        path to the index file, or None to keep the index in memory only
+    """
+
+    index_path = get_setting(['load', 'path', 'index_path'], None)
+    if index_path is None:
+        return path + '.index'
+    index_path = str(index_path)
+    if index_path == 'None':
+        return None
+    if os.path.isdir(index_path):
+        return os.path.join(index_path, os.path.basename(path) + '.index')
+    if os.path.abspath(path) != os.path.abspath(settings['load']['path']['file_path']):
+        # One of many shards
+        return path + '.index'
+    return index_path
+
+
+def get_indexed_count(path, itemfield, count):
+    """
+    Get the number of items of a file, kept in the header of its sidecar
+    index file (see get_index_path) and counted again only when missing
+    or when the file changed.
+    Input:
+        - path: str,
+        path to the file
+        - itemfield: str,
+        what was counted (e.g. the separator of delimited files), saved
+        in the header. None for the lines of JSON Lines files
+        - count: function,
+        counting the items when needed
+    Output:
+        - int, the number of items
+    """
+
+    index_path = get_index_path(path)
+    stat = os.stat(path)
+    if index_path is not None:
+        header = read_index_header(index_path, stat.st_size, stat.st_mtime, itemfield)
+        if header is not None:
+            return header['count']
+    N = count()
+    if index_path is not None:
+        header = {'size': stat.st_size, 'mtime': stat.st_mtime, 'itemfield': itemfield, 'count': N}
+        try:
+            write_index_file(index_path, header)
+        except IOError, e:
+            time_log("Couldn't save the index to %s: %s" % (index_path, e))
+    return N
+
+
+def get_file_index(path, itemfield, buf=None):
+    """
+    Get the byte-offset index of the items of a json file. The index
+    is kept in a sidecar file (see get_index_path) and rebuilt in one
+    pass when missing or when the file changed.
+    Input:
+        - path: str,
+        path to the json file
+        - itemfield: str,
+        outer field of the array of items
+        - buf: str or mmap,
+        the contents of the file, if already mapped
+    Output:
+        - JsonArrayIndex instance
+    """
+
+    index_path = get_index_path(path)
+    stat = os.stat(path)
+    if index_path is not None:
+        index = JsonArrayIndex.load(index_path, stat.st_size, stat.st_mtime, itemfield)
+        if index is not None:
+            return index
+    time_log('Indexing the %s items of %s' % (itemfield, path))
+    if buf is None and stat.st_size:
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            index = JsonArrayIndex.build(buf, itemfield)
+            buf.close()
+    else:
+        index = JsonArrayIndex.build(buf or '', itemfield)
+    time_log('Indexed %d items' % len(index))
+    if index_path is not None:
+        try:
+            index.save(index_path, stat.st_size, stat.st_mtime, itemfield)
+        except IOError, e:
+            time_log("Couldn't save the index to %s: %s" % (index_path, e))
+    return index
+
+
+def load_file_batches(key, N_collection, ind_=None):
     """
     Parse collection from file to be processed in streaming/parallel fashion.
-    Fetches step = (N X numb_cores) of documents starting from ind_ and
-    delivers it to the rest of the pipeline.
+    Fetches step = (N X numb_cores) of documents starting from the byte
+    offset ind_ and delivers it to the rest of the pipeline. This opens
+    the file for just one batch; keep a FileBatchReader alive instead
+    for reading many batches.
     Input:
         - key: str,
         the type of input to read
         - N_collection: int,
-        total collection length
-        - ind: int,
-        the starting point of the batch (or stream) to be read  
+        total collection length, for logging. 'unknown' while
+        still being counted
+        - ind_: int,
+        byte offset to start from, as returned from the previous batch.
+        None to start from the first item
     Output:
         - json_ : dic,
         json-style dictionary with a field containing
         items
+        - offset: int,
+        byte offset to continue from. None if the file was exhausted
     """
-    # Filepath to item collection
-    inp_path = settings['load']['path']['file_path']
-    # Document iterator field in the collection
-    infield = settings['load'][key]['itemfield']
-    # itemfield containing list of elements
-    out_outfield = settings['out']['json']['itemfield']
-    # The generated json_
-    json_ = {out_outfield: []}
-    # Check if streaming
-    stream_flag = str(settings['pipeline']['in']['stream']) == 'True'
-    # batch size in case of streaming enviroment is just one
-    if stream_flag:
-        step = 1
-    # else N_THREADS* Batches_per_core
-    else:
+
+    if key == 'med_rec':
+        reader = MedRecBatchReader(settings['load']['path']['file_path'], get_projection(key))
+        return reader.load_batch(key, N_collection, ind_)
+    if get_file_format(settings['load']['path']['file_path']) == 'jsonl':
+        reader = JsonLinesBatchReader(settings['load']['path']['file_path'], get_projection(key))
         try:
-            N_THREADS = int(settings['num_cores'])
-        except:
-            N_THREADS = cpu_count()
+            return reader.load_batch(key, N_collection, ind_)
+        finally:
+            reader.close()
+    reader = FileBatchReader(settings['load']['path']['file_path'], settings['load'][key]['itemfield'],
+                             get_projection(key))
+    try:
+        return reader.load_batch(key, N_collection, ind_)
+    finally:
+        reader.close()
+
+
+def get_input_shards(path):
+    """
+    Helper function to find the shards of the input, when the file_path
+    in settings is a directory or a glob pattern (e.g. /data/pubmed*.jsonl.gz).
+    Hidden files and the .index sidecar files (and those being written)
+    are left out.
+    Input:
+        - path: str,
+        the input path
+    Output:
+        - shards: list,
+        sorted list of the shard paths. None if path is a single file
+    """
+
+    if os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in os.listdir(path)]
+    elif any(char in path for char in '*?['):
+        paths = glob.glob(path)
+    else:
+        return None
+    return sorted(p for p in paths if os.path.isfile(p) and not(os.path.basename(p).startswith('.'))
+                  and not(p.endswith('.index') or '.index.' in p))
+
+
+def get_file_format(path):
+    """
+    Helper function to get the format of the input file. It is read from
+    file_format in the path load settings, or else found from the file
+    extension (.jsonl/.ndjson, optionally followed by .gz/.zst, for JSON
+    Lines files).
+    Input:
+        - path: str,
+        path to the input file
+    Output:
+        - str, 'jsonl' or 'json'
+    """
+
+    file_format = get_setting(['load', 'path', 'file_format'], None)
+    if file_format and str(file_format) != 'None':
+        return file_format
+    name = path
+    for ext in ('.gz', '.zst'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    if name.endswith('.jsonl') or name.endswith('.ndjson'):
+        return 'jsonl'
+    return 'json'
+
+
+def open_input_file(path):
+    """
+    Open an input file for reading, decompressing .gz and .zst files
+    on the fly.
+    Input:
+        - path: str,
+        path to the file
+    Output:
+        - file-like object with a read method
+    """
+
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            time_log('The zstandard package is needed to read %s' % path)
+            raise ImportError('No module named zstandard')
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+    return open(path, 'rb')
+
+
+def iter_lines(f, size=1024**2):
+    """
+    Iterate through the non-blank lines of a file-like object, reading
+    it in blocks.
+    Input:
+        - f: file-like object with a read method
+        - size: int, the size of the blocks read
+    Output:
+        - generator of lines, without the line endings
+    """
+
+    rest = ''
+    while True:
+        block = f.read(size)
+        if not block:
+            break
+        lines = (rest + block).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield line
+    if rest.strip():
+        yield rest
+
+
+class JsonLinesBatchReader(object):
+    """
+    Reader of a JSON Lines file (one item per line), optionally gzip or
+    zstandard compressed, to be kept alive across batches. The file is
+    streamed line by line and each batch continues where the previous one
+    stopped. The number of items read is used as the batch token. If
+    lazy_records is set in the path load settings, items are not decoded
+    but kept as LazyRecord.
+    """
+
+    def __init__(self, path, fields=None):
+        """
+        Initialization of the class.
+        Attributes:
+            - path: str, path to the JSON Lines file
+            - fields: list, the fields of the items to keep (see
+            get_projection). None to keep whole items
+        """
+
+        self.path = path
+        self.fields = fields
+        self.lazy = use_lazy_records()
+        self.file = None
+        self.lines = None
+        self.pos = 0
+
+    def seek(self, ind_):
+        """
+        Reopen the file and skip its first ind_ items.
+        """
+
+        self.close()
+        self.file = open_input_file(self.path)
+        self.lines = iter_lines(self.file)
+        self.pos = 0
+        for _ in xrange(ind_):
+            if next(self.lines, None) is None:
+                break
+            self.pos += 1
+
+    def count(self, start=None):
+        """
+        Number of items from position start to the end of the file. The
+        number of lines is kept in a sidecar index file (see
+        get_indexed_count), so that compressed files are scanned once
+        while they don't change.
+        """
+
+        return max(get_indexed_count(self.path, None, self.count_lines) - (start or 0), 0)
+
+    def count_lines(self):
+        """
+        Number of non-empty lines of the file.
+        """
+
+        f = open_input_file(self.path)
         try:
-            batch_per_core = int(settings['batch_per_core'])
-        except:
-            batch_per_core = 100
-        step = N_THREADS * batch_per_core
-    if step > N_collection:
-        step = N_collection
-    # Collection counter
-    col_counter = 0
-    #print infield
-    time_log("Will start from %d/%d and read %d items" % (ind_, N_collection, step))
-    with open(inp_path, 'r') as f:
-        docs = ijson2.items(f, '%s.item' % infield)
-        for c, item in enumerate(docs):
-            if c < ind_:
-                continue
-            json_[out_outfield].append(item)
-            #print json_
-            col_counter += 1
-            if col_counter >= step:
+            return sum(1 for _ in iter_lines(f))
+        finally:
+            f.close()
+
+    def read(self, lines):
+        """
+        Decode the given lines. If parallel_decode is set in the path load
+        settings, they are split in contiguous parts between the workers
+        of the pool.
+        Input:
+            - lines: list,
+            list of raw lines
+        Output:
+            - items: list,
+            list of decoded items
+        """
+
+        if self.lazy:
+            return decode_json_lines((lines, self.fields))
+        parallel = str(get_setting(['load', 'path', 'parallel_decode'], False)) == 'True'
+        N_THREADS = get_num_workers()
+        if not(parallel) or len(lines) < 2 * N_THREADS:
+            return decode_json_lines((lines, self.fields))
+        chunk = len(lines) // N_THREADS + 1
+        tasks = [(lines[i:i + chunk], self.fields) for i in xrange(0, len(lines), chunk)]
+        items = []
+        for part in get_pool().map(decode_json_lines, tasks):
+            items.extend(part)
+        return items
+
+    def load_batch(self, key, N_collection, ind_=0):
+        """
+        Parse items from a JSON Lines file to be processed in streaming/
+        parallel fashion. Fetches step = (N X numb_cores) of items starting
+        from the item ind_ and delivers them to the rest of the pipeline.
+        If batch_chars is set, the batch stops at the line that reaches
+        that many characters.
+        Input:
+            - key: str,
+            the type of input to read
+            - N_collection: int,
+            total collection length, for logging. 'unknown' while
+            still being counted
+            - ind_: int,
+            the number of items to skip, as returned from the previous
+            batch. None to start from the first item
+        Output:
+            - json_ : dic,
+            json-style dictionary with a field containing
+            items
+            - pos: int,
+            the item to continue from. None if the file was exhausted
+        """
+
+        # itemfield containing list of elements
+        out_outfield = settings['out']['json']['itemfield']
+        step = get_batch_step()
+        ind_ = ind_ or 0
+        if self.lines is None or ind_ != self.pos:
+            self.seek(ind_)
+        time_log("Will start from %d/%s and read %d items" % (self.pos, N_collection, step))
+        budget = get_batch_chars()
+        chars = 0
+        lines = []
+        exhausted = True
+        for line in self.lines:
+            lines.append(line)
+            chars += len(line)
+            if len(lines) >= step or (budget is not None and chars >= budget):
+                exhausted = False
                 break
-    
-    if col_counter == 0:
-        #print 'Col_counter'
-        #print col_counter
+        self.pos += len(lines)
+        if not lines:
+            return None, None
+        items = self.read(lines)
+        if exhausted:
+            return {out_outfield: items}, None
+        return {out_outfield: items}, self.pos
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.lines = None
+
+
+def decode_json_lines((lines, fields)):
+    """
+    Worker function decoding raw JSON Lines. If lazy_records is set in
+    the path load settings, the lines are kept as LazyRecord.
+    Input:
+        - lines: list,
+        list of raw lines, one item each
+        - fields: list,
+        the fields of the items to keep. None to keep whole items
+    Output:
+        - items: list,
+        list of decoded items
+    """
+
+    if use_lazy_records():
+        return [LazyRecord(line, fields) for line in lines]
+    return [project_fields(json.loads(line), fields) for line in lines]
+
+
+def use_lazy_records():
+    """
+    Helper function to check if the items of json and JSON Lines files
+    are kept as raw LazyRecord, decoding each field only when accessed.
+    Read from lazy_records in the path load settings.
+    Output:
+        - bool
+    """
+
+    return str(get_setting(['load', 'path', 'lazy_records'], False)) == 'True'
+
+
+def get_file_resume_offset():
+    """
+    Helper function to get the byte offset to resume reading the
+    input file from, as logged from a previous run. It is read from
+    resume_offset in the path load settings.
+    Output:
+        - int or None to start from the beginning
+    """
+
+    offset = get_setting(['load', 'path', 'resume_offset'], None)
+    if offset is None or str(offset) == 'None':
+        return None
+    return int(offset)
+
+
+def load_replay(key):
+    """
+    Load all the documents of the extraction store, to replay the
+    output phase without extracting again.
+    Input:
+        - key: str,
+        the type of input to read
+    Output:
+        - json_ : dic,
+        json-style dictionary with a field containing
+        documents
+    """
+
+    store = get_extraction_store()
+    if store is None:
+        raise ValueError('Replay needs the store path (store: path) in settings')
+    out_outfield = settings['out']['json']['itemfield']
+    return {out_outfield: store.read()}
+
+
+def load_replay_batches(key, N_collection, ind_=0):
+    """
+    Load documents from the extraction store to be processed in
+    streaming/parallel fashion. Fetches step = (N X numb_cores) of
+    documents starting from ind_, seeking directly to them through
+    the index of the store.
+    Input:
+        - key: str,
+        the type of input to read
+        - N_collection: int,
+        total collection length, for logging. 'unknown' while
+        still being counted
+        - ind: int,
+        the starting point of the batch (or stream) to be read
+    Output:
+        - json_ : dic,
+        json-style dictionary with a field containing
+        items
+    """
+
+    store = get_extraction_store()
+    if store is None:
+        raise ValueError('Replay needs the store path (store: path) in settings')
+    out_outfield = settings['out']['json']['itemfield']
+    step = get_batch_step()
+    time_log("Will start from %d/%s and read %d items" % (ind_, N_collection, step))
+    docs = store.read(ind_, ind_ + step)
+    if not docs:
         return None, None
-    else:
-        #print json_
-        return json_, ind_ + step
+    return {out_outfield: docs}, ind_ + len(docs)
 
 
-def parse_medical_rec():
+def get_batch_step():
     """
-    Parse file containing medical records.
+    Helper function to get the number of items read in each batch.
+    One in case of streaming, else num_cores X batch_per_core.
+    Output:
+        - step: int,
+        the batch size
+    """
+
+    stream_flag = str(settings['pipeline']['in']['stream']) == 'True'
+    if stream_flag:
+        return 1
+    try:
+        N_THREADS = int(settings['num_cores'])
+    except:
+        N_THREADS = cpu_count()
+    try:
+        batch_per_core = int(settings['batch_per_core'])
+    except:
+        batch_per_core = 100
+    return N_THREADS * batch_per_core
+
+
+def get_batch_chars():
+    """
+    Helper function to get the characters budget of each batch, so that
+    batches of long documents hold fewer of them. Read from batch_chars
+    in settings. The number of items is still capped by get_batch_step.
+    Output:
+        - budget: int,
+        the number of characters, or None to size batches only by count
+    """
+
+    budget = get_setting(['batch_chars'], None)
+    if budget is None or str(budget) == 'None':
+        return None
+    return int(budget)
+
+
+def cut_by_chars(sizes, budget):
+    """
+    Helper function to find how many items, from the start, make a batch
+    of the given characters budget. The batch stops at the item reaching
+    the budget and holds at least one item.
+    Input:
+        - sizes: list,
+        the number of characters of each item
+        - budget: int,
+        the characters budget
+    Output:
+        - int, the number of items
+    """
+
+    total = 0
+    for i, size in enumerate(sizes):
+        total += size
+        if total >= budget:
+            return i + 1
+    return len(sizes)
+
+
+def parse_medical_rec(inp_path=None):
+    """
+    Parse file containing medical records. The file is read in chunks,
+    keeping only the columns needed.
+    Input:
+        - inp_path: str,
+        path to the file. Defaults to the file_path in settings
     Output:
         - json_ : dic,
         json-style dictionary with documents containing
@@ -198,19 +968,62 @@ def parse_medical_rec():
     """
 
     # path to file to read from
-    inp_path = settings['load']['path']['file_path']
-    # csv seperator from settings.yaml
-    sep = settings['load']['med_rec']['sep']
+    if inp_path is None:
+        inp_path = settings['load']['path']['file_path']
+    # outerfield for the documents in json
+    itemfield = settings['out']['json']['itemfield']
+    records = []
+    for diag in read_medical_rec_chunks(inp_path, get_projection('med_rec'), chunksize=10000):
+        records.extend(normalize_medical_records(diag))
+    json_ = {itemfield: records}
+    return json_
+
+
+def read_medical_rec_chunks(inp_path, fields=None, skip=0, chunksize=None):
+    """
+    Open a delimited file of medical records for reading in chunks.
+    The first column is the index of the records.
+    Input:
+        - inp_path: str,
+        path to the delimited file
+        - fields: list,
+        the columns to read, besides the index. None to read all columns
+        - skip: int,
+        number of records to skip from the start
+        - chunksize: int,
+        number of records in each chunk. None to fetch chunks of any
+        size with get_chunk
+    Output:
+        - pandas TextFileReader, iterating through DataFrames
+    """
+
+    # csv seperator from settings.yaml, e.g. \t
+    sep = settings['load']['med_rec']['sep'].decode('string_escape')
+    usecols = None
+    if fields is not None:
+        with open(inp_path, 'r') as f:
+            columns = f.readline().rstrip('\r\n').split(sep)
+        usecols = [columns[0]] + [col for col in columns[1:] if col in fields]
+    skiprows = xrange(1, skip + 1) if skip else None
+    return pd.read_csv(inp_path, sep=sep, index_col=0, usecols=usecols, skiprows=skiprows,
+                       chunksize=chunksize, iterator=True)
+
+
+def normalize_medical_records(diag):
+    """
+    Turn a chunk of medical records to documents, normalizing the
+    id, text and label fields as indicated in the settings.
+    Input:
+        - diag: pandas DataFrame,
+        the medical records
+    Output:
+        - list of json-style documents
+    """
+
     # textfield to read text from
     textfield = settings['load']['med_rec']['textfield']
     # idfield where id of document is stored
     idfield = settings['load']['med_rec']['idfield']
-    with open(inp_path, 'r') as f:
-        diag = pd.DataFrame.from_csv(f, sep='\t')
-    # Get texts
-    texts = diag[textfield].values
-    # outerfield for the documents in json
-    itemfield = settings['out']['json']['itemfield']
     # textfield to read text from
     out_textfield = settings['out']['json']['json_text_field']
     # labelfield where title of the document is stored
@@ -224,10 +1037,127 @@ def parse_medical_rec():
     # Replace id with default out_idfield
     diag['id'] = diag[idfield]
     del diag[idfield]
-    json_ = {itemfield: diag.to_dict(orient='records')}
-    return json_
+    return diag.to_dict(orient='records')
 
 
+def count_medical_records(inp_path):
+    """
+    Count the records of a delimited file, reading only its first column.
+    The count is kept in a sidecar index file (see get_indexed_count),
+    so that the file is read again only when it changes.
+    Input:
+        - inp_path: str,
+        path to the delimited file
+    Output:
+        - int, the number of records
+    """
+
+    sep = settings['load']['med_rec']['sep'].decode('string_escape')
+
+    def count():
+        N = 0
+        for chunk in pd.read_csv(inp_path, sep=sep, usecols=[0], chunksize=100000):
+            N += len(chunk)
+        return N
+
+    return get_indexed_count(inp_path, 'sep:%s' % sep, count)
+
+
+class MedRecBatchReader(object):
+    """
+    Reader of a delimited file of medical records, to be kept alive
+    across batches. The file is streamed in chunks of one batch each,
+    reading only the columns needed. The number of records read is
+    used as the batch token.
+    """
+
+    def __init__(self, path, fields=None):
+        """
+        Initialization of the class.
+        Attributes:
+            - path: str, path to the delimited file
+            - fields: list, the columns to read (see get_projection).
+            None to read all columns
+        """
+
+        self.path = path
+        self.fields = fields
+        self.chunks = None
+        # Records read but left for the next batch
+        self.pending = None
+        self.exhausted = False
+        self.pos = 0
+
+    def count(self, start=None):
+        """
+        Number of records from position start to the end of the file.
+        """
+
+        return max(count_medical_records(self.path) - (start or 0), 0)
+
+    def load_batch(self, key, N_collection, ind_=0):
+        """
+        Parse medical records to be processed in streaming/parallel fashion.
+        Fetches step = (N X numb_cores) of records starting from the record
+        ind_ and delivers them to the rest of the pipeline. If batch_chars
+        is set, the batch stops at the record whose text reaches that many
+        characters.
+        Input:
+            - key: str,
+            the type of input to read
+            - N_collection: int,
+            total collection length, for logging. 'unknown' while
+            still being counted
+            - ind_: int,
+            the number of records to skip, as returned from the previous
+            batch. None to start from the first record
+        Output:
+            - json_ : dic,
+            json-style dictionary with a field containing
+            items
+            - pos: int,
+            the record to continue from. None if the file was exhausted
+        """
+
+        # itemfield containing list of elements
+        out_outfield = settings['out']['json']['itemfield']
+        step = get_batch_step()
+        ind_ = ind_ or 0
+        if self.chunks is None or ind_ != self.pos:
+            self.chunks = read_medical_rec_chunks(self.path, self.fields, skip=ind_)
+            self.pending = None
+            self.exhausted = False
+            self.pos = ind_
+        time_log("Will start from %d/%s and read %d items" % (ind_, N_collection, step))
+        diag = self.pending
+        self.pending = None
+        missing = step - (len(diag) if diag is not None else 0)
+        if missing > 0 and not(self.exhausted):
+            try:
+                chunk = self.chunks.get_chunk(missing)
+                self.exhausted = len(chunk) < missing
+                diag = chunk if diag is None else pd.concat([diag, chunk])
+            except StopIteration:
+                self.exhausted = True
+        if diag is None or not len(diag):
+            return None, None
+        budget = get_batch_chars()
+        if budget is not None:
+            textfield = settings['load']['med_rec']['textfield']
+            sizes = diag[textfield].fillna('').astype(unicode).str.len().tolist()
+            n = cut_by_chars(sizes, budget)
+            if n < len(diag):
+                self.pending = diag.iloc[n:]
+                diag = diag.iloc[:n]
+        records = normalize_medical_records(diag.copy())
+        self.pos += len(records)
+        if self.exhausted and self.pending is None:
+            return {out_outfield: records}, None
+        return {out_outfield: records}, self.pos
+
+    def close(self):
+        self.chunks = None
+        self.pending = None
 
 
 def parse_text(json_):
@@ -267,24 +1197,93 @@ def parse_text(json_):
     out_idfield = settings['out']['json']['json_id_field']
     # labelfield where title of the document is stored
     out_labelfield = settings['out']['json']['json_label_field']
-    json_[outfield] = [art for art in json_[outfield] if textfield in art.keys()]
-    json_[outfield] = [art for art in json_[outfield] if langid.classify(art[textfield])[0] == 'en']
+    languages = iter(detect_languages([art[textfield] for art in json_[outfield] if textfield in art]))
+    articles = []
     for article in json_[outfield]:
+        if not(textfield in article):
+            continue
+        if languages.next() != 'en':
+            continue
         article[out_textfield] = article.pop(textfield)
         article[out_idfield] = article.pop(idfield)
         if labelfield != 'None':
             article[out_labelfield] = article.pop(labelfield)
         else:
             article[out_labelfield] = ' '
-        if not('journal' in article.keys()):
+        if not('journal' in article):
             article['journal'] = 'None'
-    json_[out_outfield] = json_.pop(outfield)
-    # N = len(json_[out_outfield])
-    # json_[out_outfield] = json_[out_outfield][(2*N/5):(3*N/5)]
-    json_[out_outfield] = json_[out_outfield][:]
+        articles.append(article)
+    json_.pop(outfield)
+    json_[out_outfield] = articles
     return json_
 
 
+def detect_languages(texts):
+    """
+    Identify the language of the given texts. Only a prefix of each text
+    is classified (langid_prefix in the text load settings, defaults to
+    1000 characters) and the results are memoized by the hash of the
+    prefix. In parallel mode the prefixes not seen before are classified
+    by the workers of the pool.
+    Input:
+        - texts: list,
+        list of texts
+    Output:
+        - list of the language codes (e.g. 'en') of the texts,
+        in the same order
+    """
+
+    global _LANGUAGES
+    prefix = int(get_setting(['load', 'text', 'langid_prefix'], 1000))
+    # The memo may be reset by another reading thread, so the languages
+    # of this call are collected apart from it
+    memo = _LANGUAGES
+    keys = []
+    found = {}
+    missing = {}
+    for text in texts:
+        text = text[:prefix]
+        key = hashlib.sha1(text.encode('utf-8') if isinstance(text, unicode) else text).digest()
+        keys.append(key)
+        lang = memo.get(key)
+        if lang is None:
+            missing[key] = text
+        else:
+            found[key] = lang
+    if missing:
+        missing_keys = missing.keys()
+        missing_texts = [missing[key] for key in missing_keys]
+        N_THREADS = get_num_workers()
+        parallel = str(settings['pipeline']['in']['parallel']) == 'True'
+        if parallel and len(missing_texts) >= 4 * N_THREADS:
+            chunk = len(missing_texts) // (4 * N_THREADS) + 1
+            chunks = [missing_texts[i:i + chunk] for i in xrange(0, len(missing_texts), chunk)]
+            langs = []
+            for part in get_pool().map(classify_languages, chunks):
+                langs.extend(part)
+        else:
+            langs = classify_languages(missing_texts)
+        found.update(zip(missing_keys, langs))
+        if len(_LANGUAGES) + len(missing) > 1000000:
+            _LANGUAGES = {}
+        _LANGUAGES.update(zip(missing_keys, langs))
+    return [found[key] for key in keys]
+
+
+def classify_languages(texts):
+    """
+    Worker function classifying the language of each of the texts
+    with langid.
+    Input:
+        - texts: list,
+        list of texts
+    Output:
+        - list of language codes
+    """
+
+    return [langid.classify(text)[0] for text in texts]
+
+
 def parse_remove_edges(key=None):
     """
     Dummy function to conform with the pipeline when
@@ -319,35 +1318,90 @@ def parse_remove_edges(key=None):
     return {}
 
 
-def get_collection_count(source, type):
+def get_collection_count(source, type, query=None, inp_path=None):
     """
-    Helper function to get total collection length.
+    Helper function to get total collection length. For files the count
+    kept in the header of the sidecar index is used, building the index
+    if needed. For mongo the estimated count from the collection metadata
+    is used, or a count of the documents matching query if given.
     Input:
         - source: str, value denoting where we will read from (e.g 'mongo')
         - type: str, value denoting what we will read (e.g. text, edges)
+        - query: dic, mongo filter of the documents to be counted
+        - inp_path: str, the file to count, for a shard. Defaults to the
+        file_path in settings
     Output:
         - N_collection: int,
         number of items in the collection
     """
-    if source == 'file':
-        inp_path = settings['load']['path']['file_path'] 
+    if inp_path is None and source == 'file':
+        inp_path = settings['load']['path']['file_path']
+    if source == 'file' and type == 'med_rec':
+        N_collection = count_medical_records(inp_path)
+    elif source == 'file' and get_file_format(inp_path) == 'jsonl':
+        N_collection = JsonLinesBatchReader(inp_path).count()
+    elif source == 'file':
         # Document iterator field in the collection
         infield = settings['load'][type]['itemfield']
-        with open(inp_path, 'r') as f:
-            docs = ijson2.items(f, '%s.item' % infield)
-            N_collection = 0
-            for item in docs:
-                N_collection += 1
+        index_path = get_index_path(inp_path)
+        stat = os.stat(inp_path)
+        header = None
+        if index_path is not None:
+            header = read_index_header(index_path, stat.st_size, stat.st_mtime, infield)
+        if header is not None:
+            N_collection = header['count']
+        else:
+            N_collection = len(get_file_index(inp_path, infield))
     elif source == 'mongo':
         # input mongo variables from settings.yaml
         uri = settings['load']['mongo']['uri']
         db_name = settings['load']['mongo']['db']
         collection_name = settings['load']['mongo']['collection']
-        client = pymongo.MongoClient(uri)
+        client = get_mongo_client(uri)
         db = client[db_name]
         collection = db[collection_name]
-        N_collection = collection.count()
+        # Older pymongo versions only have count
+        if query:
+            if hasattr(collection, 'count_documents'):
+                N_collection = collection.count_documents(query)
+            else:
+                N_collection = collection.find(query).count()
+        elif hasattr(collection, 'estimated_document_count'):
+            N_collection = collection.estimated_document_count()
+        else:
+            N_collection = collection.count()
+    elif source == 'replay':
+        store = get_extraction_store()
+        N_collection = len(store) if store is not None else 0
     else:
         time_log("Can't calculate total collection count for source type %s" % settings['in']['source'])
         raise NotImplementedError
     return N_collection
+
+
+class CollectionCounter(threading.Thread):
+    """
+    Count the items to be read in the background, so that the pipeline
+    can start reading batches before the total is known. total stays
+    None until the count finishes.
+    """
+
+    def __init__(self, count):
+        """
+        Initialization of the class.
+        Attributes:
+            - count: function, returning the number of items
+        """
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.count = count
+        self.total = None
+
+    def run(self):
+        try:
+            self.total = self.count()
+        except Exception, e:
+            time_log("Couldn't count the collection: %s" % e)
+            return
+        time_log('Counted %d items to read' % self.total)
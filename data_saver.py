@@ -13,8 +13,9 @@ import unicodecsv as csv2
 import pymongo
 from config import settings
 from utilities import time_log
+from json_stream import LazyRecord, dumps_json
 from data_extractor import chunk_document_collection
-from multiprocessing import cpu_count, Pool
+from workers import get_pool, get_num_workers, get_neo4j_graph
 
 
 suppress_log_to_file = py2neo.watch('neo4j',
@@ -54,7 +55,7 @@ def save_json(json_):
                 docs1 = json.load(f)[settings['out']['json']['json_doc_field']]
             json_[settings['out']['json']['json_doc_field']] = json_[settings['out']['json']['json_doc_field']] + docs1
     with open(outfile, 'w+') as f:
-        json.dump(json_, f, indent=3)
+        f.write(dumps_json(json_, indent=3))
 
     # with open (outfile, mode="r+") as file:
     #     file.seek(0,2)
@@ -772,10 +773,7 @@ def update_neo4j_parallel(results):
         #    exit()
         #else:
         #    return
-    try:
-        N_THREADS = int(settings['num_cores'])
-    except:
-        N_THREADS = cpu_count()
+    N_THREADS = get_num_workers()
     # results = {'nodes': [{'type': 'Entity', 'values': entities_nodes}, {'type': 'Article', 'values': articles_nodes}],
     #            'edges': [{'type': 'relation', 'values': relations_edges}, {'type': 'mention', 'values': entity_pmc_edges}]
     #            }
@@ -793,11 +791,7 @@ def update_neo4j_parallel(results):
             par_res[batch_num]['edges'][i]['values'] = par_edges[batch_num]
     len_col = " | ".join([str(len(b)) for b in par_edges])
     time_log('Will break the collection into batches of: %s  %s edges!' % (len_col, edges['type']))
-    pool = Pool(N_THREADS, maxtasksperchild=1)
-    res = pool.map(update_neo4j_parallel_worker, par_res)
-    pool.close()
-    pool.join()
-    del pool
+    res = get_pool().map(update_neo4j_parallel_worker, par_res)
     if sum(res) == N_THREADS:
         time_log('Completed parallel update of Neo4j!')
     else:
@@ -838,12 +832,8 @@ def update_neo4j(results):
         details
     Output: None, creates/merges the nodes to the wanted database
     """
-    host = settings['neo4j']['host']
-    port = settings['neo4j']['port']
-    user = settings['neo4j']['user']
-    password = settings['neo4j']['password']
     try:
-        graph = py2neo.Graph(host=host, port=port, user=user, password=password)
+        graph = get_neo4j_graph()
     except Exception, e:
         #time_log(e)
         #time_log("Couldn't connect to db! Check settings!")
@@ -936,6 +926,8 @@ def save_mongo(json_):
     idfield = settings['out']['json']['json_id_field']
     docs = json_[settings['out']['json']['itemfield']]
     for i, doc in enumerate(docs):
+        if isinstance(doc, LazyRecord):
+            doc = doc.materialize()
         if idfield in doc:
             result = collection.replace_one({'id': str(doc[idfield])}, doc, True)
         elif 'p' in doc:
@@ -0,0 +1,161 @@
+#!/usr/bin/python !/usr/bin/env python
+# -*- coding: utf-8 -*
+
+
+# Materialized store of the extracted documents. Every Extractor run
+# appends its per-document output here, so that the output phase can be
+# replayed (e.g. after changing the neo4j schema) without re-extracting.
+
+import os
+import json
+import zlib
+import hashlib
+from config import settings, get_setting
+from utilities import time_log
+from json_stream import dumps_json
+
+
+# The store opened by the current process
+_EXTRACTION_STORE = None
+
+
+class ExtractionStore(object):
+    """
+    Append-only store of documents. Each document is kept as a zlib
+    compressed json record in the .dat file, while the .idx file holds
+    one line per record with the document id and the offset and length
+    of the record. When a document is stored more than once, the last
+    record is the one served.
+    """
+
+    def __init__(self, path):
+        """
+        Initialization of the class.
+        Attributes:
+            - path: str, path prefix of the .dat and .idx files
+        """
+
+        self.data_path = path + '.dat'
+        self.index_path = path + '.idx'
+        # id -> (offset, length)
+        self.index = {}
+        # ids in the order they were first stored
+        self.order = []
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'r') as f:
+                for line in f:
+                    # Older stores kept the hash of the text too
+                    record = json.loads(line)
+                    doc_id, offset, length = record[0], record[-2], record[-1]
+                    if not(doc_id in self.index):
+                        self.order.append(doc_id)
+                    self.index[doc_id] = (offset, length)
+        self.data_file = open(self.data_path, 'ab')
+        self.index_file = open(self.index_path, 'a')
+
+    def __len__(self):
+        return len(self.order)
+
+    def put_many(self, docs, idfield):
+        """
+        Append the given documents to the store.
+        Input:
+            - docs: list,
+            list of json-style documents
+            - idfield: str,
+            field where the id of each document is found
+        """
+
+        self.data_file.seek(0, 2)
+        offset = self.data_file.tell()
+        records = []
+        lines = []
+        for doc in docs:
+            record = zlib.compress(dumps_json(doc))
+            doc_id = doc[idfield]
+            if not(doc_id in self.index):
+                self.order.append(doc_id)
+            self.index[doc_id] = (offset, len(record))
+            lines.append(json.dumps([doc_id, offset, len(record)]) + '\n')
+            records.append(record)
+            offset += len(record)
+        self.data_file.write(''.join(records))
+        self.data_file.flush()
+        self.index_file.write(''.join(lines))
+        self.index_file.flush()
+
+    def read(self, start=0, stop=None):
+        """
+        Read the stored documents with positions in [start, stop),
+        in the order they were first stored.
+        Input:
+            - start: int,
+            position of the first document
+            - stop: int,
+            position after the last document. Defaults to the end
+        Output:
+            - docs: list,
+            list of json-style documents
+        """
+
+        docs = []
+        with open(self.data_path, 'rb') as f:
+            for doc_id in self.order[start:stop]:
+                offset, length = self.index[doc_id]
+                f.seek(offset)
+                docs.append(json.loads(zlib.decompress(f.read(length))))
+        return docs
+
+
+def text_fingerprint(text):
+    """
+    Hash of a text, used to find documents with the same text.
+    Input:
+        - text: str,
+        the text to hash
+    Output:
+        - str, hex digest of the text
+    """
+
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).hexdigest()
+
+
+def get_extraction_store():
+    """
+    Get the extraction store, opening it if needed. Returns None
+    if store path is not set in settings.
+    Output:
+        - ExtractionStore instance or None
+    """
+
+    global _EXTRACTION_STORE
+    path = get_setting(['store', 'path'], None)
+    if not path or str(path) == 'None':
+        return None
+    if _EXTRACTION_STORE is None:
+        _EXTRACTION_STORE = ExtractionStore(path)
+    return _EXTRACTION_STORE
+
+
+def store_documents(json_):
+    """
+    Persist the documents of an Extractor run to the extraction store,
+    if one is set in settings. Only documents with the configured text
+    field are stored (e.g. not the relations of edges input).
+    Input:
+        - json_: dic,
+        json-style dictionary with a field containing the documents
+    """
+
+    store = get_extraction_store()
+    if store is None:
+        return
+    textfield = settings['out']['json']['json_text_field']
+    docs = [doc for doc in json_.get(settings['out']['json']['itemfield'], [])
+            if textfield in doc]
+    if not docs:
+        return
+    store.put_many(docs, settings['out']['json']['json_id_field'])
+    time_log('Stored %d extracted documents. Store has %d documents' % (len(docs), len(store)))
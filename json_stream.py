@@ -0,0 +1,438 @@
+#!/usr/bin/python !/usr/bin/env python
+# -*- coding: utf-8 -*
+
+
+# Helpers to walk big .json files without decoding them. The structural
+# characters and strings are matched with a regular expression over an
+# mmap of the file, which gives the byte span of every item in the
+# array of documents/relations, so that items can be decoded one by one,
+# indexed and seeked to. The same spans let single fields of an item be
+# decoded on access (see LazyRecord).
+
+import os
+import re
+import json
+import threading
+import collections
+import numpy as np
+from json.decoder import scanstring
+from json.scanner import make_scanner
+
+
+# Strings (with escaped characters) and structural characters of json
+JSON_TOKEN_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{},:]')
+
+# Whitespace between json tokens
+WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+
+# C scanner of a json value, returning it and the offset after it
+_SCAN_VALUE = make_scanner(json.JSONDecoder())
+
+# Placeholder of a LazyRecord in the output of json.dumps
+LAZY_MARK_RE = re.compile(r'"\\u0000lazy(\d+)\\u0000"')
+
+
+def find_json_array(buf, itemfield):
+    """
+    Find the array stored under a key of the outer json object.
+    Input:
+        - buf: str or mmap,
+        the contents of the json file
+        - itemfield: str,
+        the key of the outer object holding the array (e.g. documents)
+    Output:
+        - int, the offset right after the opening '[' of the array, or
+        None if it was not found
+    """
+
+    key = '"%s"' % itemfield
+    depth = 0
+    pending = False
+    for match in JSON_TOKEN_RE.finditer(buf):
+        token = match.group()
+        char = token[0]
+        if char == '"':
+            pending = depth == 1 and token == key
+            continue
+        if char == ':':
+            continue
+        if char == '[' and pending:
+            return match.end()
+        pending = False
+        if char in '{[':
+            depth += 1
+        elif char in '}]':
+            depth -= 1
+    return None
+
+
+def iter_json_array(buf, pos):
+    """
+    Iterate through the items of a json array, without decoding them.
+    Input:
+        - buf: str or mmap,
+        the contents of the json file
+        - pos: int,
+        offset right after the opening '[' of the array, or right after
+        the ',' following an item (e.g. a previously returned next_pos)
+    Output:
+        - generator of (start, end, next_pos) tuples, where buf[start:end]
+        is the raw item and next_pos the offset to resume after it
+    """
+
+    depth = 0
+    seg_start = pos
+    for match in JSON_TOKEN_RE.finditer(buf, pos):
+        char = match.group()[0]
+        if char in '{[':
+            depth += 1
+        elif char in '}]':
+            if depth == 0:
+                # End of the array
+                span = _strip_span(buf, seg_start, match.start())
+                if span:
+                    yield span[0], span[1], match.start()
+                return
+            depth -= 1
+        elif char == ',' and depth == 0:
+            span = _strip_span(buf, seg_start, match.start())
+            if span:
+                yield span[0], span[1], match.end()
+            seg_start = match.end()
+
+
+class JsonArrayIndex(object):
+    """
+    Byte offsets and lengths of the items of a json array. Once built,
+    counting the items is O(1) and any item can be decoded directly from
+    its span. Saved as a sidecar file: a json header line with the size
+    and mtime of the indexed file, followed by the starts and ends of the
+    items as little-endian int64.
+    """
+
+    def __init__(self, starts, ends):
+        """
+        Initialization of the class.
+        Attributes:
+            - starts: numpy array, offset where each item starts
+            - ends: numpy array, offset where each item ends
+        """
+
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def build(cls, buf, itemfield):
+        """
+        Index the array stored under itemfield in one pass, without
+        decoding the items.
+        Input:
+            - buf: str or mmap,
+            the contents of the json file
+            - itemfield: str,
+            the key of the outer object holding the array
+        Output:
+            - JsonArrayIndex instance, empty if no array was found
+        """
+
+        starts = []
+        ends = []
+        pos = find_json_array(buf, itemfield)
+        if pos is not None:
+            for start, end, _ in iter_json_array(buf, pos):
+                starts.append(start)
+                ends.append(end)
+        return cls(np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64))
+
+    def locate(self, offset):
+        """
+        Position of the first item starting at or after a byte offset.
+        Input:
+            - offset: int,
+            byte offset, e.g. as returned from offset_of. None for the
+            first item
+        Output:
+            - int, the position of the item
+        """
+
+        if offset is None:
+            return 0
+        return int(np.searchsorted(self.starts, offset))
+
+    def offset_of(self, i):
+        """
+        Byte offset of the item in position i, None past the last item.
+        """
+
+        if i >= len(self.starts):
+            return None
+        return int(self.starts[i])
+
+    def save(self, path, size, mtime, itemfield):
+        """
+        Write the index to a sidecar file.
+        Input:
+            - path: str,
+            path to the index file
+            - size, mtime: int, float,
+            size and modification time of the indexed file
+            - itemfield: str,
+            the key of the indexed array
+        """
+
+        header = {'size': size, 'mtime': mtime, 'itemfield': itemfield, 'count': len(self)}
+        write_index_file(path, header, self.starts, self.ends)
+
+    @classmethod
+    def load(cls, path, size, mtime, itemfield):
+        """
+        Read an index saved with save. Returns None if there is no
+        index file or it was built for another version of the file.
+        """
+
+        header = read_index_header(path, size, mtime, itemfield)
+        if header is None:
+            return None
+        N = header['count']
+        with open(path, 'rb') as f:
+            f.readline()
+            offsets = np.fromfile(f, dtype='<i8', count=2 * N).astype(np.int64)
+        if len(offsets) != 2 * N:
+            return None
+        return cls(offsets[:N], offsets[N:])
+
+
+def iter_json_fields(buf):
+    """
+    Iterate through the fields of a json object, without keeping their
+    values. The end of each value is found with the C scanner of the
+    json module, which is faster than walking its tokens in python.
+    Input:
+        - buf: str,
+        a raw json object
+    Output:
+        - generator of (key, start, end) tuples, where buf[start:end] is
+        the raw value of the field key
+    """
+
+    skip = WHITESPACE_RE.match
+    pos = skip(buf, buf.find('{') + 1).end()
+    if buf[pos] == '}':
+        return
+    while True:
+        key, pos = scanstring(buf, pos + 1, 'utf-8')
+        # Skip the ':' after the key
+        start = skip(buf, skip(buf, pos).end() + 1).end()
+        end = _SCAN_VALUE(buf, start)[1]
+        yield key, start, end
+        pos = skip(buf, end).end()
+        if buf[pos] != ',':
+            return
+        pos = skip(buf, pos + 1).end()
+
+
+class LazyRecord(collections.MutableMapping):
+    """
+    Item of a json file kept as its raw bytes. The fields are located on
+    first access and each value is decoded only when read, so that items
+    cost little more than their size in the file. Fields never read or
+    assigned are written back verbatim by dumps_json.
+    """
+
+    def __init__(self, raw, fields=None):
+        """
+        Initialization of the class.
+        Attributes:
+            - raw: str, the raw json object
+            - fields: list, the fields to keep. None to keep all of them
+            - spans: dic, the (start, end) of the raw value of each field
+            not yet decoded. None till the fields are located
+            - values: dic, the decoded or assigned values
+            - order: list, the fields in their order
+        """
+
+        self.raw = raw
+        self.fields = fields
+        self.spans = None
+        self.values = {}
+        self.order = None
+
+    def locate(self):
+        """
+        Find the spans of the fields, once.
+        """
+
+        if self.spans is not None:
+            return
+        self.spans = {}
+        self.order = []
+        keep = set(self.fields) if self.fields is not None else None
+        for key, start, end in iter_json_fields(self.raw):
+            if keep is not None and not(key in keep):
+                continue
+            if not(key in self.spans):
+                self.order.append(key)
+            self.spans[key] = (start, end)
+
+    def __getitem__(self, key):
+        if key in self.values:
+            return self.values[key]
+        self.locate()
+        if not(key in self.spans):
+            raise KeyError(key)
+        start, end = self.spans.pop(key)
+        value = json.loads(self.raw[start:end])
+        self.values[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.locate()
+        if not(key in self.spans or key in self.values):
+            self.order.append(key)
+        self.spans.pop(key, None)
+        self.values[key] = value
+
+    def __delitem__(self, key):
+        self.locate()
+        if not(key in self.spans or key in self.values):
+            raise KeyError(key)
+        self.spans.pop(key, None)
+        self.values.pop(key, None)
+        self.order.remove(key)
+
+    def __contains__(self, key):
+        if key in self.values:
+            return True
+        self.locate()
+        return key in self.spans
+
+    def __iter__(self):
+        self.locate()
+        return iter(list(self.order))
+
+    def __len__(self):
+        self.locate()
+        return len(self.order)
+
+    def __repr__(self):
+        return 'LazyRecord(%r)' % self.materialize()
+
+    def materialize(self):
+        """
+        Decode all the fields.
+        Output:
+            - dic, the whole item
+        """
+
+        return dict((key, self[key]) for key in self)
+
+    def dumps(self):
+        """
+        Encode the item, copying the raw value of the fields that were
+        never decoded.
+        Output:
+            - str, the json object
+        """
+
+        if self.spans is None and self.fields is None:
+            return self.raw
+        self.locate()
+        parts = []
+        for key in self.order:
+            if key in self.spans:
+                start, end = self.spans[key]
+                value = self.raw[start:end]
+            else:
+                value = json.dumps(self.values[key])
+            parts.append(json.dumps(key) + ': ' + value)
+        return '{' + ', '.join(parts) + '}'
+
+
+def dumps_json(obj, **kwargs):
+    """
+    json.dumps that also encodes the LazyRecord items of obj, writing
+    their untouched fields verbatim.
+    Input:
+        - obj: the data to encode
+        - kwargs: the arguments of json.dumps
+    Output:
+        - str, the json string
+    """
+
+    records = []
+
+    def mark(item):
+        if not(isinstance(item, LazyRecord)):
+            raise TypeError('%r is not JSON serializable' % (item,))
+        records.append(item)
+        return u'\x00lazy%d\x00' % (len(records) - 1)
+
+    out = json.dumps(obj, default=mark, **kwargs)
+    if not records:
+        return out
+    return LAZY_MARK_RE.sub(lambda match: records[int(match.group(1))].dumps(), out)
+
+
+def write_index_file(path, header, *arrays):
+    """
+    Write an index file: the json header line followed by the given
+    arrays as little-endian int64. Written aside and renamed, as another
+    reader may be indexing the same file.
+    Input:
+        - path: str,
+        path to the index file
+        - header: dic,
+        the header, with the size and mtime of the indexed file
+        - arrays: numpy arrays,
+        the offsets to write after the header, if any
+    """
+
+    tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+    with open(tmp_path, 'wb') as f:
+        f.write(json.dumps(header) + '\n')
+        for array in arrays:
+            f.write(array.astype('<i8').tostring())
+    os.rename(tmp_path, path)
+
+
+def read_index_header(path, size, mtime, itemfield):
+    """
+    Read the header of an index file, checking it matches the file and
+    array to be read.
+    Input:
+        - path: str,
+        path to the index file
+        - size, mtime: int, float,
+        size and modification time of the indexed file
+        - itemfield: str,
+        the key of the indexed array
+    Output:
+        - header: dic or None if missing or stale
+    """
+
+    try:
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline())
+    except (IOError, ValueError):
+        return None
+    if (header.get('size') != size or header.get('mtime') != mtime or
+            header.get('itemfield') != itemfield):
+        return None
+    return header
+
+
+def _strip_span(buf, start, end):
+    """
+    Trim the whitespace around buf[start:end]. Returns None if only
+    whitespace was found.
+    """
+
+    raw = buf[start:end]
+    stripped = raw.lstrip()
+    if not stripped:
+        return None
+    start += len(raw) - len(stripped)
+    return start, start + len(stripped.rstrip())
@@ -0,0 +1,95 @@
+#!/usr/bin/python !/usr/bin/env python
+# -*- coding: utf-8 -*
+
+
+# Ledger of the documents already processed by previous runs, so that an
+# incremental run only reads and extracts the documents that arrived
+# since then.
+
+import os
+import json
+from config import get_setting
+from utilities import time_log
+
+
+# The ledger opened by the current process
+_PROCESSED_LEDGER = None
+
+
+class ProcessedLedger(object):
+    """
+    Append-only record of processed documents. Each line of the file is
+    either ["id", doc_id] for a processed document or ["watermark", _id]
+    for the last mongo _id processed. Mongo collections are read after
+    the watermark with an indexed query, while documents read from files
+    are skipped when their id is in the ledger.
+    """
+
+    def __init__(self, path):
+        """
+        Initialization of the class.
+        Attributes:
+            - path: str, path to the ledger file
+        """
+
+        self.path = path
+        self.ids = set()
+        self.watermark = None
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    kind, value = json.loads(line)
+                    if kind == 'id':
+                        self.ids.add(value)
+                    else:
+                        self.watermark = value
+        self.file = open(path, 'a')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.ids
+
+    def add(self, ids, watermark=None):
+        """
+        Record a batch of processed documents.
+        Input:
+            - ids: list,
+            the ids of the processed documents
+            - watermark: str or other _id value,
+            the resume token of the last mongo _id processed (see
+            mongo_id_token), if reading from mongo
+        """
+
+        lines = []
+        for doc_id in ids:
+            if not(doc_id in self.ids):
+                self.ids.add(doc_id)
+                lines.append(json.dumps(['id', doc_id]) + '\n')
+        if watermark is not None:
+            if not isinstance(watermark, (int, long, float, basestring)):
+                watermark = str(watermark)
+            self.watermark = watermark
+            lines.append(json.dumps(['watermark', watermark]) + '\n')
+        self.file.write(''.join(lines))
+        self.file.flush()
+
+
+def get_processed_ledger():
+    """
+    Get the ledger of processed documents, opening it if needed.
+    Returns None if the incremental mode is not enabled in the load
+    settings.
+    Output:
+        - ProcessedLedger instance or None
+    """
+
+    global _PROCESSED_LEDGER
+    if str(get_setting(['load', 'incremental', 'enabled'], False)) != 'True':
+        return None
+    if _PROCESSED_LEDGER is None:
+        _PROCESSED_LEDGER = ProcessedLedger(get_setting(['load', 'incremental', 'ledger_path'], 'processed.ledger'))
+        time_log('Incremental mode: %d documents already processed. Watermark: %s' %
+                 (len(_PROCESSED_LEDGER), _PROCESSED_LEDGER.watermark))
+    return _PROCESSED_LEDGER
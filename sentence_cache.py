@@ -0,0 +1,182 @@
+#!/usr/bin/python !/usr/bin/env python
+# -*- coding: utf-8 -*
+
+
+# On-disk cache of the SemRep results of single sentences, so that
+# sentences already seen (e.g. boilerplate in abstracts or a re-ingested
+# collection) are not sent to SemRep again.
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+from config import get_setting
+from utilities import time_log
+
+
+# The cache of the current (worker) process
+_SENTENCE_CACHE = None
+# Access times are only refreshed when older than this many seconds, so
+# that most hits are plain reads
+ACCESS_REFRESH = 3600
+# The stored size is summed again every this many puts, to account for
+# the values stored by the other workers sharing the file
+EVICT_CHECK = 100
+
+
+class SentenceCache(object):
+    """
+    Key-value store of sentence results, backed by an sqlite file.
+    Keys are hashes of the normalized sentence text together with the
+    SemRep binary and flags, values are the compressed list of sentences
+    (entities and relations) SemRep generated. When the stored values
+    exceed max_bytes, the least recently used entries are evicted.
+    A running total of the stored size is kept, and the access time of
+    an entry is only written when older than ACCESS_REFRESH seconds.
+    """
+
+    def __init__(self, path, max_bytes=1024**3, version=''):
+        """
+        Initialization of the class.
+        Attributes:
+            - path: str, path to the sqlite file
+            - max_bytes: int, maximum size of the stored values
+            - version: str, the SemRep binary and flags, part of each key
+        """
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.pid = os.getpid()
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.text_factory = str
+        self.conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, '
+                          'value BLOB, size INTEGER, accessed REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+        self.conn.commit()
+        self.puts = 0
+        self.total = self.stored_size()
+
+    def stored_size(self):
+        """
+        Size of all the values stored in the file.
+        """
+
+        return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+
+    def key(self, sentence):
+        """
+        Content-addressed key of a normalized sentence.
+        """
+
+        if isinstance(sentence, unicode):
+            sentence = sentence.encode('utf-8')
+        return hashlib.sha1(self.version + '\x00' + sentence).hexdigest()
+
+    def get_many(self, keys):
+        """
+        Fetch the values of the given keys, updating the hit/miss
+        counters and the stale access times of the hits.
+        Input:
+            - keys: list,
+            list of keys as generated from self.key
+        Output:
+            - found: dic,
+            dictionary of the keys found to their values
+        """
+
+        found = {}
+        stale = []
+        now = time.time()
+        keys = list(set(keys))
+        for i in xrange(0, len(keys), 500):
+            part = keys[i:i + 500]
+            query = 'SELECT key, value, accessed FROM cache WHERE key IN (%s)' % ','.join('?' * len(part))
+            for key, value, accessed in self.conn.execute(query, part):
+                found[key] = json.loads(zlib.decompress(value))
+                if now - accessed > ACCESS_REFRESH:
+                    stale.append((now, key))
+        if stale:
+            self.conn.executemany('UPDATE cache SET accessed = ? WHERE key = ?', stale)
+            self.conn.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        """
+        Store the given values, evicting old entries if needed.
+        Input:
+            - items: dic,
+            dictionary of keys to values
+        """
+
+        now = time.time()
+        rows = []
+        for key, value in items.iteritems():
+            blob = zlib.compress(json.dumps(value))
+            rows.append((key, sqlite3.Binary(blob), len(blob), now))
+        self.conn.executemany('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)', rows)
+        self.conn.commit()
+        self.total += sum(row[2] for row in rows)
+        self.puts += 1
+        if self.total > self.max_bytes or self.puts % EVICT_CHECK == 0:
+            self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries, till the stored values
+        are under 90% of max_bytes.
+        """
+
+        self.total = self.stored_size()
+        if self.total <= self.max_bytes:
+            return
+        excess = self.total - int(0.9 * self.max_bytes)
+        freed = 0
+        old_keys = []
+        for key, size in self.conn.execute('SELECT key, size FROM cache ORDER BY accessed'):
+            old_keys.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self.conn.executemany('DELETE FROM cache WHERE key = ?', old_keys)
+        self.conn.commit()
+        self.total -= freed
+        time_log('Evicted %d sentences from the SemRep cache' % len(old_keys))
+
+    def report(self):
+        """
+        Log the hit/miss counters.
+        """
+
+        total = self.hits + self.misses
+        ratio = 100 * self.hits / float(total) if total else 0
+        time_log('SemRep sentence cache: %d hits | %d misses -- %0.2f %% hit ratio' %
+                 (self.hits, self.misses, ratio))
+
+
+def get_sentence_cache(version=''):
+    """
+    Get the sentence cache of the current process, creating it if
+    needed. Returns None if semrep cache_path is not set in settings.
+    Input:
+        - version: str,
+        the SemRep binary and flags used
+    Output:
+        - SentenceCache instance or None
+    """
+
+    global _SENTENCE_CACHE
+    path = get_setting(['semrep', 'cache_path'], None)
+    if not path or str(path) == 'None':
+        return None
+    # sqlite connections must not be shared with forked processes
+    if _SENTENCE_CACHE is None or _SENTENCE_CACHE.pid != os.getpid():
+        max_mb = float(get_setting(['semrep', 'cache_max_mb'], 1024))
+        _SENTENCE_CACHE = SentenceCache(path, int(max_mb * 1024**2), version)
+    return _SENTENCE_CACHE
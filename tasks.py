@@ -6,14 +6,29 @@
 # a task to complete, such as reading from file, extracting concepts
 # and saving to disk again.
 
-from config import settings
+import os
+import sys
+import json
+import Queue
+import itertools
+import threading
+from functools import partial
+from config import settings, get_setting
 from utilities import time_log
-from data_loader import load_file, load_file_batches, load_mongo, load_mongo_batches, \
-                        parse_remove_edges, parse_text, get_collection_count
+from ledger import get_processed_ledger
+from data_loader import load_file, load_mongo, load_mongo_batches, \
+                        load_replay, load_replay_batches, parse_remove_edges, parse_text, \
+                        get_collection_count, get_mongo_resume_token, get_file_resume_offset, \
+                        FileBatchReader, MedRecBatchReader, JsonLinesBatchReader, \
+                        CollectionCounter, get_file_format, get_input_shards, get_projection, to_mongo_id, \
+                        mongo_id_token
 from data_extractor import extract_semrep, extract_semrep_parallel, extract_metamap, \
-                           get_concepts_from_edges, get_concepts_from_edges_parallel
+                           extract_metamap_parallel, get_concepts_from_edges, get_concepts_from_edges_parallel, \
+                           dedup_documents, fan_out_duplicates
 from data_saver import save_csv, save_neo4j, save_json, save_json2, create_neo4j_results, \
                         create_neo4j_csv, update_neo4j, update_mongo_sentences, save_mongo, update_neo4j_parallel
+from extraction_store import store_documents
+from workers import close_pool, get_pool, get_recycle_tasks
 from tqdm import tqdm
 import ijson.backends.yajl2_cffi as ijson2
 
@@ -26,37 +41,70 @@ class Parser(object):
     Filepaths and details according to settings.yaml.
     """
 
-    def __init__(self, source, key, name=None):
+    def __init__(self, source, key, name=None, path=None):
         """
         Initialization of the class.
         Attributes:
             - source: str, value denoting where we will read from (e.g 'mongo')
             - type: str, value denoting what we will read (e.g. text, edges)
             - name: str, The name is only for pretty-printing purposes.
+            - path: str, the file to read, for the Parser of a single
+            shard. Defaults to the file_path in settings, which can also
+            be a directory or glob of shards
         """
 
         self.source = source
         self.key = key
         parallel_flag = str(settings['pipeline']['in']['parallel']) == 'True'
         stream_flag = str(settings['pipeline']['in']['stream']) == 'True'
+        self.reader = None
+        self.path = None
+        self.shards = None
+        if self.source == 'file':
+            self.path = path or settings['load']['path']['file_path']
+            if path is None:
+                self.shards = get_input_shards(self.path)
         if self.source == 'mongo':
             if parallel_flag or stream_flag:
                 self.load = load_mongo_batches
             else:
                 self.load = load_mongo
         elif self.source == 'file':
-            if parallel_flag or stream_flag:
-                self.load = load_file_batches
+            if self.shards is not None:
+                # In batch mode each shard is read by its own Parser,
+                # see read_shard_batches
+                self.load = self.load_shards
+            elif (parallel_flag or stream_flag) and self.key == 'med_rec':
+                # Kept alive across batches, streaming the file in chunks
+                self.reader = MedRecBatchReader(self.path, get_projection(self.key))
+                self.load = self.reader.load_batch
+            elif (parallel_flag or stream_flag) and get_file_format(self.path) == 'jsonl':
+                # Kept alive across batches, streaming the file line by line
+                self.reader = JsonLinesBatchReader(self.path, get_projection(self.key))
+                self.load = self.reader.load_batch
+            elif parallel_flag or stream_flag:
+                # Kept alive across batches, reading the file in one pass
+                self.reader = FileBatchReader(self.path, settings['load'][self.key]['itemfield'],
+                                              get_projection(self.key))
+                self.load = self.reader.load_batch
             else:
-                self.load = load_file
+                self.load = partial(load_file, inp_path=self.path)
         elif self.source == 'delete':
             self.load = parse_remove_edges
+        elif self.source == 'replay':
+            if parallel_flag or stream_flag:
+                self.load = load_replay_batches
+            else:
+                self.load = load_replay
         else:
             time_log('Source to read was %s. Please change settings' % self.source)
             raise NotImplementedError
-        if self.key == 'text':
+        if self.source == 'replay':
+            # Documents in the store are already parsed
+            self.parse = None
+        elif self.key == 'text':
             self.parse = parse_text
-        elif self.key == 'med_red':
+        elif self.key == 'med_rec':
             self.parse = None
         elif self.key == 'edges':
             self.parse = None
@@ -67,18 +115,122 @@ class Parser(object):
             self.name = name
         else:
             self.name = 'Type: %s From : %s' % (self.source, self.key)
+        # Documents processed by previous runs, in incremental mode
+        self.ledger = None
+        if self.key == 'text' and self.source != 'replay':
+            self.ledger = get_processed_ledger()
+        # Starting point of the batch reading and number of items read
+        if self.source == 'mongo':
+            self.start = get_mongo_resume_token()
+            if self.start is None and self.ledger is not None:
+                self.start = to_mongo_id(self.ledger.watermark)
+        elif self.source == 'file' and path is None:
+            self.start = get_file_resume_offset()
+        else:
+            self.start = None if self.source == 'file' else 0
+        self.n_read = 0
+        # Resume state of each shard, the token to continue from or
+        # 'done' when read to the end
+        self.shard_state = {}
+        self.shard_state_path = get_setting(['load', 'path', 'shard_state'], None)
+        if self.shards is not None:
+            if self.shard_state_path and str(self.shard_state_path) != 'None' and \
+                    os.path.isfile(self.shard_state_path):
+                with open(self.shard_state_path, 'r') as f:
+                    self.shard_state = json.load(f)
+            time_log('Reading %d shards from %s. %d of them already done' %
+                     (len(self.shards), self.path, len(self.pending_shards(done=True))))
+
+    def count(self):
+        """
+        Number of items left to read, starting from self.start.
+        Output:
+            - N: int, the number of items
+        """
+
+        if self.shards is not None:
+            return sum(Parser(self.source, self.key, path=path).count_from(self.shard_state.get(path))
+                       for path in self.pending_shards())
+        if self.reader is not None:
+            return self.reader.count(self.start)
+        if self.source == 'mongo' and self.start is not None:
+            return get_collection_count(self.source, self.key, {'_id': {'$gt': self.start}})
+        return get_collection_count(self.source, self.key, inp_path=self.path)
+
+    def count_from(self, start):
+        """
+        Number of items left to read from a shard, starting from start.
+        """
+
+        self.start = start
+        count = self.count()
+        self.close()
+        return count
+
+    def close(self):
+        """
+        Close the reader of the file, if any.
+        """
+
+        if self.reader is not None:
+            self.reader.close()
+
+    def pending_shards(self, done=False):
+        """
+        The shards still to be read, or those already read if done.
+        """
+
+        return [path for path in self.shards
+                if (self.shard_state.get(path) == 'done') == done]
+
+    def load_shards(self, key):
+        """
+        Load and merge all the shards, when not reading in batches.
+        Input:
+            - key: str, the type of input to read
+        Output:
+            - json_: dict, the items of all shards
+        """
+
+        if key == 'med_rec':
+            field = settings['out']['json']['itemfield']
+        else:
+            field = settings['load'][key]['itemfield']
+        json_ = {field: []}
+        for path in self.shards:
+            json_[field].extend(load_file(key, path)[field])
+        return json_
+
+    def save_shard_state(self, path, ind_):
+        """
+        Keep the token to continue reading a shard from, after one of its
+        batches was processed, writing the state file if set in settings.
+        Input:
+            - path: str, the shard
+            - ind_: the token returned with the batch. None when the
+            shard was read to the end
+        """
+
+        self.shard_state[path] = ind_ if ind_ is not None else 'done'
+        if self.shard_state_path and str(self.shard_state_path) != 'None':
+            with open(self.shard_state_path + '.tmp', 'w') as f:
+                json.dump(self.shard_state, f)
+            os.rename(self.shard_state_path + '.tmp', self.shard_state_path)
 
     def read(self, N=None, ind_=0):
         """
         Run the corresponding parsing function and return:
         Input:
-            - ind_: int, the starting point to read from
+            - ind_: int, the starting point to read from. For mongo
+            this is the last _id read and for files the byte offset
+            after the last item read (resume token)
         Output:
         1) In case of the batch or streaming processing:
             - json_: dict, the corresponding read batch
             - N: int, the total number of items to iterate through
             - ind_: int, the index where the next iteration of readings
-            should start from
+            should start from. For mongo the last _id read and for files
+            the byte offset after the last item read
 
         2) In case of loading the whole collection:
             - json_: dict, the corresponding collection
@@ -86,7 +238,15 @@ class Parser(object):
         parallel_flag = str(settings['pipeline']['in']['parallel']) == 'True'
         stream_flag = str(settings['pipeline']['in']['stream']) == 'True'
         if parallel_flag or stream_flag:
-            json_, ind_ = self.load(self.key, N, ind_)
+            while True:
+                json_, ind_ = self.load(self.key, N, ind_)
+                if not json_:
+                    break
+                self.n_read += len(json_.get(settings['out']['json']['itemfield'], []))
+                json_ = self.skip_processed(json_)
+                # Read on if the whole batch was already processed
+                if self.ledger is None or json_[settings['load']['text']['itemfield']] or ind_ is None:
+                    break
             if json_:
                 if self.parse:
                     json_ = self.parse(json_)
@@ -94,11 +254,151 @@ class Parser(object):
             return json_, ind_
         else:
             json_ = self.load(self.key)
+            json_ = self.skip_processed(json_)
             if self.parse:
                 json_ = self.parse(json_)
             time_log('Completed Parsing. Read: %d documents!' % len(json_[settings['out']['json']['itemfield']]))
             return json_
 
+    def skip_processed(self, json_):
+        """
+        Drop the documents processed by previous runs, in incremental mode.
+        Input:
+            - json_: dict, the loaded documents
+        Output:
+            - json_: dict, the documents not yet processed
+        """
+
+        if self.ledger is None:
+            return json_
+        outfield = settings['load']['text']['itemfield']
+        idfield = settings['load']['text']['idfield']
+        docs = json_[outfield]
+        json_[outfield] = [doc for doc in docs if not(doc.get(idfield) in self.ledger)]
+        if len(docs) > len(json_[outfield]):
+            time_log('Skipped %d documents already processed' % (len(docs) - len(json_[outfield])))
+        return json_
+
+    def mark_processed(self, json_, ind_=None):
+        """
+        Record the processed documents in the ledger, in incremental mode.
+        For mongo the last _id read is kept as the watermark.
+        Input:
+            - json_: dict, the processed documents
+            - ind_: the resume token returned along with the documents
+        """
+
+        if self.ledger is None:
+            return
+        ids = [doc[settings['out']['json']['json_id_field']]
+               for doc in json_[settings['out']['json']['itemfield']]]
+        watermark = mongo_id_token(ind_) if self.source == 'mongo' else None
+        self.ledger.add(ids, watermark)
+
+
+def read_batches(parser, counter, ind_):
+    """
+    Generator of the batches of the parser, till the input is exhausted.
+    Input:
+        - parser: Parser instance, in batch/streaming mode
+        - counter: CollectionCounter instance, counting the items to read
+        - ind_: the resume token to start from
+    Output:
+        - generator of (json_, ind_, n_batch, path) tuples, with the batch
+        read, the resume token after it, the number of items read for it
+        and the file read (None if not reading files)
+    """
+
+    while True:
+        N = counter.total
+        n_read = parser.n_read
+        json_, ind_ = parser.read(N=N if N is not None else 'unknown', ind_=ind_)
+        if not json_:
+            return
+        yield json_, ind_, parser.n_read - n_read, parser.path
+        if ind_ is None:
+            return
+
+
+def read_shard_batches(parser, path, counter):
+    """
+    Generator of the batches of one shard, read by its own Parser, which
+    is created only when the shard is reached.
+    Input:
+        - parser: Parser instance, of the sharded input
+        - path: str, the shard to read
+        - counter: CollectionCounter instance, counting the items to read
+    Output:
+        - generator of batches, as from read_batches
+    """
+
+    shard = Parser(parser.source, parser.key, path=path)
+    try:
+        for batch in read_batches(shard, counter, parser.shard_state.get(path)):
+            yield batch
+    finally:
+        shard.close()
+
+
+class BatchPrefetcher(object):
+    """
+    Read batches in background threads, keeping up to size of them
+    ready in a bounded queue. Reading and parsing the next batches then
+    overlaps with the extraction and saving of the current one, while
+    the bound caps the memory held by batches waiting. Each thread reads
+    one of the given batch iterators (e.g. one per shard) at a time.
+    """
+
+    def __init__(self, batches, size, readers=1):
+        """
+        Initialization of the class.
+        Attributes:
+            - batches: list of iterators of the batches to read, as from
+            read_batches
+            - size: int, the maximum number of batches kept ready
+            - readers: int, the number of reading threads
+        """
+
+        self.pending = Queue.Queue()
+        for iterator in batches:
+            self.pending.put(iterator)
+        self.queue = Queue.Queue(size)
+        self.error = None
+        self.threads = []
+        for i in xrange(max(1, min(readers, len(batches)))):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            self.threads.append(thread)
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        try:
+            while self.error is None:
+                try:
+                    batches = self.pending.get_nowait()
+                except Queue.Empty:
+                    break
+                for batch in batches:
+                    self.queue.put(batch)
+        except Exception:
+            self.error = sys.exc_info()
+        self.queue.put(None)
+
+    def __iter__(self):
+        running = len(self.threads)
+        while running:
+            batch = self.queue.get()
+            if batch is None:
+                running -= 1
+                continue
+            yield batch
+        if self.error is not None:
+            # Re-raise the reading error in the consuming thread
+            raise self.error[0], self.error[1], self.error[2]
+
 
 class Extractor(object):
     """
@@ -129,8 +429,11 @@ class Extractor(object):
             else:
                 self.func = extract_semrep
         elif self.key == 'metamap':
-            self.func = extract_metamap
-            # self.func = extract_metamap
+            if str(settings['pipeline']['in']['parallel']) == 'True':
+                self.func = extract_metamap_parallel
+                time_log('Will use multiprocessing for the metamap extraction!')
+            else:
+                self.func = extract_metamap
         elif self.key == 'reverb':
             raise NotImplementedError
         elif self.key == 'get_concepts_from_edges':
@@ -151,7 +454,17 @@ class Extractor(object):
         """
 
         if type(json) == dict:
+            slots = None
+            if self.key in ['semrep', 'metamap'] and str(get_setting(['dedup_texts'], True)) == 'True':
+                # Extract once per distinct text
+                N = len(json[settings['out']['json']['itemfield']])
+                json, slots = dedup_documents(json)
+                if slots is not None:
+                    time_log('%d documents with %d distinct texts. Saved %d %s calls!' %
+                             (N, len(json[settings['out']['json']['itemfield']]),
+                              N - len(json[settings['out']['json']['itemfield']]), self.key))
             json_ = self.func(json, self.parser_key)
+            json_ = fan_out_duplicates(json_, slots)
             time_log('Completed extracting using %s!' % self.name)
         else:
             time_log('Unsupported type of json to work on!')
@@ -243,6 +556,29 @@ class taskCoordinator(object):
                 if value:
                     self.pipeline[phase][key] = value
 
+    def extract(self, dic, parser, json_):
+        """
+        Run the extractors of the trans phase on the documents. Once all
+        of them are done, the documents are appended to the extraction
+        store, if set in settings.
+        Input:
+            - dic: dict, the trans phase of the pipeline
+            - parser: Parser, the parser the documents were read with
+            - json_: dict, the documents
+        Output:
+            - json_: dict, the enriched documents
+        """
+
+        extracted = False
+        for key, value in dic.iteritems():
+            if value:
+                extractor = Extractor(key, parser.key)
+                json_ = extractor.run(json_)
+                extracted = True
+        if extracted:
+            store_documents(json_)
+        return json_
+
     def run(self):
         parallel_flag = False
         stream_flag = False
@@ -250,50 +586,89 @@ class taskCoordinator(object):
             parallel_flag = True
         if 'stream' in self.pipeline['in']:
             stream_flag = True
-        if parallel_flag or stream_flag:
-            parser = Parser(self.pipeline['in']['source'], self.pipeline['in']['type'])
-            ind_ = 0
-            N = get_collection_count(parser.source, parser.key)
-            while ind_ < N:
-                old_ind = ind_
-                json_all, ind_ = parser.read(N=N, ind_=ind_)
-                outfield = settings['out']['json']['itemfield']
-                if json_all:
+        try:
+            if parallel_flag or stream_flag:
+                parser = Parser(self.pipeline['in']['source'], self.pipeline['in']['type'])
+                prefetch = int(get_setting(['prefetch_batches'], 2))
+                recycle = get_recycle_tasks()
+                if recycle is not None and prefetch > 0:
+                    # Replacement workers would be forked while the reading
+                    # threads hold locks (files, db clients, logging)
+                    time_log('recycle_tasks needs prefetch_batches: 0. Please change settings')
+                    raise NotImplementedError
+                # Fork the workers before any thread starts (counter or
+                # readers), as locks held by threads are copied to the child
+                get_pool()
+                # The total is counted in the background, reading starts
+                # right away with an unknown total
+                counter = CollectionCounter(parser.count)
+                counter.start()
+                if recycle is not None:
+                    # No thread may be running when workers are replaced
+                    counter.join()
+                if parser.shards is not None:
+                    # One reader per shard, each resuming from its own state
+                    batches = [read_shard_batches(parser, path, counter)
+                               for path in parser.pending_shards()]
+                else:
+                    # Where the next batch starts from. A byte offset for files
+                    # and the last seen _id (resume token) for mongo
+                    batches = [read_batches(parser, counter, parser.start)]
+                if prefetch > 0:
+                    readers = int(get_setting(['load', 'path', 'shard_readers'], 2))
+                    batches = BatchPrefetcher(batches, prefetch, readers)
+                    batches.start()
+                else:
+                    batches = itertools.chain(*batches)
+                n_read = 0
+                for json_all, ind_, n_batch, path in batches:
+                    n_read += n_batch
                     json_ = json_all
                     for phase in self.phases:
                         dic = self.pipeline[phase]
-                        if phase == 'trans':
-                            for key, value in dic.iteritems():
-                                if value:
-                                    extractor = Extractor(key, parser.key)
-                                    json_ = extractor.run(json_)
+                        if phase == 'trans' and parser.source != 'replay':
+                            json_ = self.extract(dic, parser, json_)
                         if phase == 'out':
                             for key, value in sorted(dic.iteritems()):
                                 if value:
                                     dumper = Dumper(key, parser.key)
                                     dumper.save(json_)
-                if ind_:
-                    time_log('Processed %d documents in parallel. We are at index %d!' % (ind_ - old_ind, ind_))
-                    proc = int(ind_/float(N)*100)
-                if proc % 10 == 0 and proc > 0:
-                    time_log('~'*50)
-                    time_log('We are at %d/%d documents processed -- %0.2f %%' % (ind_, N, proc))
-                    time_log('~'*50)
-        else:
-            parser = Parser(self.pipeline['in']['source'], self.pipeline['in']['type'])
-            json_ = parser.read()
-            for phase in self.phases:
-                dic = self.pipeline[phase]
-                if phase == 'trans':
-                    for key, value in dic.iteritems():
-                        if value:
-                            extractor = Extractor(key, parser.key)
-                            json_ = extractor.run(json_)
-                if phase == 'out':
-                    for key, value in sorted(dic.iteritems()):
-                        if value:
-                            dumper = Dumper(key, parser.key)
-                            dumper.save(json_)
+                    parser.mark_processed(json_, ind_)
+                    time_log('Processed %d documents in parallel. We are at %d!' % (n_batch, n_read))
+                    if parser.shards is not None:
+                        parser.save_shard_state(path, ind_)
+                        time_log('Shard %s: resume token %s. %d/%d shards done' %
+                                 (path, parser.shard_state[path], len(parser.pending_shards(done=True)),
+                                  len(parser.shards)))
+                    elif parser.source == 'mongo':
+                        time_log('Resume token (last _id read): %s' % mongo_id_token(ind_))
+                    elif parser.source == 'file' and ind_ is not None:
+                        time_log('Resume token (%s): %d' % ('byte offset' if isinstance(parser.reader, FileBatchReader) else 'item', ind_))
+                    N = counter.total
+                    if N is None:
+                        time_log('We are at %d documents processed -- unknown total' % n_read)
+                    else:
+                        proc = int(n_read/float(max(N, 1))*100)
+                        if proc % 10 == 0 and proc > 0:
+                            time_log('~'*50)
+                            time_log('We are at %d/%d documents processed -- %0.2f %%' % (n_read, N, proc))
+                            time_log('~'*50)
+            else:
+                parser = Parser(self.pipeline['in']['source'], self.pipeline['in']['type'])
+                json_ = parser.read()
+                for phase in self.phases:
+                    dic = self.pipeline[phase]
+                    if phase == 'trans' and parser.source != 'replay':
+                        json_ = self.extract(dic, parser, json_)
+                    if phase == 'out':
+                        for key, value in sorted(dic.iteritems()):
+                            if value:
+                                dumper = Dumper(key, parser.key)
+                                dumper.save(json_)
+                parser.mark_processed(json_)
+        finally:
+            # Workers are shared across all batches and stages
+            close_pool()
 
         # else:
         #     if 'stream' in self.pipeline['in']:
@@ -415,6 +790,7 @@ class taskCoordinator(object):
 
     def print_pipeline(self):
         print('#'*30 + ' Pipeline Schedule' + '#'*30)
+        dic_in = self.pipeline['in']
         for phase in self.phases:
             dic = self.pipeline[phase]
             if phase == 'in':
@@ -425,8 +801,12 @@ class taskCoordinator(object):
                     source = settings['load']['path']['file_path']
                 elif dic['source'] == 'mongo':
                     source = settings['load']['mongo']['file_path']
+                elif dic['source'] == 'replay':
+                    source = settings['store']['path']
                 print('Will read from: %s' % source)
-            if phase == 'trans':
+            if phase == 'trans' and dic_in['source'] == 'replay':
+                print('Will replay the stored extractions, skipping transformations')
+            elif phase == 'trans':
                 print('Will use the following transformation utilities:')
                 for key, value in dic.iteritems():
                     print ('- %s' % key)
@@ -0,0 +1,52 @@
+#!/usr/bin/python !/usr/bin/env python
+# -*- coding: utf-8 -*
+
+
+# The tests read their own settings, so that they don't need (or touch)
+# a settings.yaml. Tests changing a setting go through SettingsTestCase.
+
+import os
+import unittest
+
+os.environ['MEDKNOW_SETTINGS'] = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                              'settings_test_yaml')
+
+# Marker of a setting that didn't exist
+MISSING = object()
+
+
+class SettingsTestCase(unittest.TestCase):
+    """
+    Test case that can change settings for a single test. The previous
+    values are restored on tearDown.
+    """
+
+    def setUp(self):
+        self.saved_settings = []
+
+    def tearDown(self):
+        for container, key, value in reversed(self.saved_settings):
+            if value is MISSING:
+                container.pop(key, None)
+            else:
+                container[key] = value
+
+    def set_setting(self, keys, value):
+        """
+        Set a nested setting for the current test.
+        Input:
+            - keys: list,
+            list of nested keys (e.g. ['semrep', 'cache_path'])
+            - value: object,
+            the value of the setting
+        """
+
+        from config import settings
+        container = settings
+        for key in keys[:-1]:
+            if not(key in container):
+                self.saved_settings.append((container, key, MISSING))
+                container[key] = {}
+            container = container[key]
+        self.saved_settings.append((container, keys[-1], container.get(keys[-1], MISSING)))
+        container[keys[-1]] = value
@@ -0,0 +1,271 @@
+#!/usr/bin/python !/usr/bin/env python
+# -*- coding: utf-8 -*
+
+
+# Tests of the helpers of the extractors.
+
+import sys
+import unittest
+import tests
+from data_extractor import frame_semrep_input, split_semrep_output, cache_miss_units, \
+                           split_semrep_sents, pack_semrep_sents, unpack_semrep_sents, \
+                           dedup_documents, fan_out_duplicates, \
+                           MetaMapProcess, frame_metamap_input, \
+                           parse_mmi_lines, mmi_record, group_metamap_concepts, metamap_sentences, \
+                           SEMREP_BEGIN_MARKER, SEMREP_END_MARKER
+
+
+def text_line(sentence):
+    """
+    SemRep text line of a sentence.
+    """
+
+    return 'SE|0000000000||ti|1|text|%s' % sentence
+
+
+def entity_line(name):
+    """
+    SemRep entity line.
+    """
+
+    return 'SE|0000000000||ti|1|entity|C0000000|%s|dsyn|||%s||888|0|0' % (name, name)
+
+
+def marker_output(marker):
+    """
+    SemRep output of a marker sentence, which may find entities in it.
+    """
+
+    return [text_line(marker + '.'), entity_line(marker)]
+
+
+class FrameSemRepInputTest(unittest.TestCase):
+
+    def test_frame(self):
+        framed, end = frame_semrep_input([u'First text.', u'Caf\xe9 text.'], first=5)
+        self.assertEqual(end, SEMREP_END_MARKER % 6)
+        self.assertEqual(framed, '%s.\n\nFirst text.\n\n%s.\n\nCaf\xc3\xa9 text.\n\n%s.\n\n' %
+                         (SEMREP_BEGIN_MARKER % 5, SEMREP_BEGIN_MARKER % 6, end))
+
+    def test_empty(self):
+        framed, end = frame_semrep_input([], first=1)
+        self.assertEqual(framed, '%s.\n\n' % end)
+
+
+class SplitSemRepOutputTest(unittest.TestCase):
+
+    def test_split(self):
+        lines = (marker_output(SEMREP_BEGIN_MARKER % 3) +
+                 [text_line('Aspirin.'), entity_line('Aspirin'), 'not an SE line'] +
+                 marker_output(SEMREP_BEGIN_MARKER % 4) +
+                 [text_line('Fever.'), entity_line('Fever'), text_line('Pain.')] +
+                 marker_output(SEMREP_END_MARKER % 4))
+        out = split_semrep_output(lines, 3, 2)
+        self.assertEqual(out, [[text_line('Aspirin.'), entity_line('Aspirin')],
+                               [text_line('Fever.'), entity_line('Fever'), text_line('Pain.')]])
+
+    def test_empty_text(self):
+        lines = (marker_output(SEMREP_BEGIN_MARKER % 1) + marker_output(SEMREP_BEGIN_MARKER % 2) +
+                 [text_line('Fever.')] + marker_output(SEMREP_END_MARKER % 2))
+        self.assertEqual(split_semrep_output(lines, 1, 2), [[], [text_line('Fever.')]])
+
+    def test_missing_end(self):
+        # Lines after the last text are kept even if the end marker is lost
+        lines = marker_output(SEMREP_BEGIN_MARKER % 1) + [text_line('Fever.')]
+        self.assertEqual(split_semrep_output(lines, 1, 1), [[text_line('Fever.')]])
+
+    def test_other_batch(self):
+        # Markers of texts outside the batch are ignored with their lines
+        lines = (marker_output(SEMREP_BEGIN_MARKER % 9) + [text_line('Old.')] +
+                 marker_output(SEMREP_BEGIN_MARKER % 1) + [text_line('New.')])
+        self.assertEqual(split_semrep_output(lines, 1, 1), [[text_line('New.')]])
+
+
+class CacheMissUnitsTest(unittest.TestCase):
+
+    def test_units(self):
+        doc_sents = [(['a', 'b', 'c'], ['A.', 'B.', 'C.']), (['b', 'd'], ['B.', 'D.']),
+                     (['a'], ['A.'])]
+        # The missing sentences of a document stay together, once each
+        self.assertEqual(cache_miss_units(doc_sents, {'b': []}),
+                         [(['a', 'c'], ['A.', 'C.']), (['d'], ['D.'])])
+        self.assertEqual(cache_miss_units(doc_sents, {'a': [], 'b': [], 'c': [], 'd': []}), [])
+
+    def test_long(self):
+        doc_sents = [(['a', 'b', 'c'], ['A' * 6, 'B' * 6, 'C' * 20])]
+        self.assertEqual(cache_miss_units(doc_sents, {}, N=14),
+                         [(['a', 'b'], ['A' * 6, 'B' * 6]), (['c'], ['C' * 20])])
+
+
+class SplitSemRepSentsTest(unittest.TestCase):
+
+    def test_split(self):
+        sents = ['Word Foo.', 'Word Foo.', 'Fever in the U.S. Army.']
+        results = [{'sent_text': 'Word Foo.\n'}, {'sent_text': 'Word  Foo.'},
+                   {'sent_text': 'Fever in the U.S.'}, {'sent_text': 'Army.'}]
+        # SemRep may break a sentence in two
+        self.assertEqual(split_semrep_sents(results, sents),
+                         [results[:1], results[1:2], results[2:]])
+
+    def test_merged(self):
+        # A sentence SemRep joined to the previous one gets no results
+        sents = ['Dr.', 'Smith came.']
+        results = [{'sent_text': 'Dr. Smith came.'}]
+        self.assertEqual(split_semrep_sents(results, sents), [results, []])
+
+    def test_unknown(self):
+        sents = ['First.', 'Second.']
+        results = [{'sent_text': 'Second.'}, {'sent_text': 'Changed text.'}]
+        self.assertEqual(split_semrep_sents(results, sents), [[], results])
+
+
+class PackSemRepSentsTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        sents = [{'sent_id': '1', 'sent_text': 'Aspirin treats fever.',
+                  'entities': [{'cuid': 'C1', 'label': 'Aspirin', 'sem_types': 'phsu', 'score': '1000'}],
+                  'relations': [{'subject__cui': 'C1', 'predicate': 'TREATS', 'object__cui': 'C2'}]},
+                 {'sent_id': '2', 'sent_text': 'Nothing.', 'entities': [], 'relations': []}]
+        out = unpack_semrep_sents(pack_semrep_sents(sents))
+        self.assertEqual(out[1], sents[1])
+        self.assertEqual(out[0]['entities'], sents[0]['entities'])
+        # Missing relation fields are packed as None
+        relation = dict((key, value) for key, value in out[0]['relations'][0].iteritems()
+                        if value is not None)
+        self.assertEqual(relation, sents[0]['relations'][0])
+
+
+class DedupDocumentsTest(unittest.TestCase):
+
+    def test_no_duplicates(self):
+        docs = [{'id': 1, 'text': 'Some text'}, {'id': 2, 'text': 'Other'}, {'id': 3}]
+        json_, slots = dedup_documents({'documents': list(docs)})
+        self.assertIsNone(slots)
+        self.assertEqual(json_['documents'], docs)
+        self.assertEqual(fan_out_duplicates(json_, slots)['documents'], docs)
+
+    def test_fan_out(self):
+        docs = [{'id': 1, 'text': 'Some  text'}, {'id': 2, 'text': 'Other'},
+                {'id': 3, 'text': ' Some text\n'}, {'id': 4}, {'id': 5}, {'id': 6, 'text': 'Other'}]
+        json_, slots = dedup_documents({'documents': docs})
+        # Documents without text are never merged
+        self.assertEqual([doc['id'] for doc in json_['documents']], [1, 2, 4, 5])
+        for doc in json_['documents']:
+            doc['sents'] = ['sents of %d' % doc['id']]
+        docs = fan_out_duplicates(json_, slots)['documents']
+        self.assertEqual([doc['id'] for doc in docs], [1, 2, 3, 4, 5, 6])
+        self.assertEqual([doc['sents'] for doc in docs],
+                         [['sents of %d' % i] for i in [1, 2, 1, 4, 5, 2]])
+        self.assertEqual(docs[2]['text'], 'Some  text')
+        self.assertNotIn('text', docs[3])
+
+
+# MetaMap stand-in: one MMI line per capitalized word (and an AA line for
+# words in capitals), then the EOT line of the input line
+FAKE_METAMAP = r'''
+import sys
+sys.stdout.write('banner line\n')
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    id_, sent = line.rstrip('\n').split('|', 1)
+    for word in sent.split():
+        if word.isupper():
+            sys.stdout.write('%s|AA|%s|x|1|1|0:1\n' % (id_, word))
+        elif word[:1].isupper():
+            sys.stdout.write('%s|MMI|9.5|%s|C%s|[sosy]|["x"-tx-1-"x"]|TX|0/1|\n' % (id_, word, len(word)))
+    sys.stdout.write('%s\n' % ' <<< EOT >>> ')
+    sys.stdout.flush()
+'''
+
+
+class FakeMetaMapProcess(MetaMapProcess):
+
+    def command(self):
+        return [sys.executable, '-c', FAKE_METAMAP], None
+
+
+class FrameMetaMapInputTest(unittest.TestCase):
+
+    def test_frame(self):
+        framed, N = frame_metamap_input([[u'One  two.', u' '], [], [u'Three\nfour.']], 7)
+        self.assertEqual(framed, 'MK7_0_0|One two.\nMK7_2_0|Three four.\n')
+        self.assertEqual(N, 2)
+        self.assertEqual(frame_metamap_input([[u''], []], 1), ('', 0))
+
+
+class MetaMapProcessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.proc = FakeMetaMapProcess(timeout=10)
+
+    def tearDown(self):
+        self.proc.close()
+
+    def test_process(self):
+        docs = [[u'Fever and Cough.', u'   ', u'no concepts here.'], [], [u'Rash in ACE.']]
+        out = self.proc.process(docs)
+        self.assertEqual([[[line.split('|')[3] for line in lines] for lines in sents] for sents in out],
+                         [[['Fever', 'Cough.'], [], []], [], [['Rash', 'x']]])
+        self.assertEqual([line.split('|')[1] for line in out[2][0]], ['MMI', 'AA'])
+        self.assertEqual(out[0][0][0].split('|')[0], 'MK1_0_0')
+        # The next batch reads its own lines only
+        out = self.proc.process([[u'Headache.']])
+        self.assertEqual([[len(lines) for lines in sents] for sents in out], [[1]])
+        self.assertEqual(out[0][0][0].split('|')[0], 'MK2_0_0')
+        self.assertEqual(self.proc.n_docs, 4)
+
+    def test_no_sentences(self):
+        self.assertEqual(self.proc.process([[u' '], []]), [[[]], []])
+
+    def test_restart(self):
+        self.proc.process([[u'Fever.']])
+        self.proc.proc.kill()
+        self.proc.proc.wait()
+        out = self.proc.process([[u'Cough.']])
+        self.assertEqual(len(out[0][0]), 1)
+        self.assertTrue(self.proc.alive())
+
+
+def concept(index, name, cui):
+    """
+    pymetamap-like MMI concept.
+    """
+
+    return (str(index), 'MMI', '9.5', name, cui, '[sosy]', '["x"-tx-1-"x"]', 'TX', '0/1', '')
+
+
+class MetaMapConceptsTest(unittest.TestCase):
+
+    def test_mmi_record(self):
+        self.assertEqual(mmi_record(concept(0, 'Fever', 'C1')), ('Fever', 'C1', '[sosy]', '9.5'))
+        self.assertIsNone(mmi_record(('0', 'AA', 'FY', 'fiscal year', '1', '2')))
+        self.assertIsNone(mmi_record(('0', 'MMI')))
+
+    def test_parse_mmi_lines(self):
+        lines = ['MK1_0_0|MMI|9.5|Fever|C1|[sosy]|["x"-tx-1-"x"]|TX|0/1|\n',
+                 'MK1_0_0|AA|FY|fiscal year|1|2|0:2\n',
+                 'MK1_0_0|MMI|3.2|Cough|C2|[sosy,fndg]|["x"-tx-1-"x"]|TX|5/5|']
+        self.assertEqual(parse_mmi_lines(lines),
+                         [('Fever', 'C1', '[sosy]', '9.5'), ('Cough', 'C2', '[sosy,fndg]', '3.2')])
+        self.assertEqual(parse_mmi_lines([]), [])
+
+    def test_group(self):
+        concepts = [concept(2, 'Rash', 'C3'), concept(0, 'Fever', 'C1'), concept(5, 'Out', 'C9'),
+                    ('1', 'AA', 'FY', 'fiscal year', '1', '2'), concept(0, 'Cough', 'C2')]
+        groups = group_metamap_concepts(concepts, 3)
+        self.assertEqual([[record[0] for record in records] for records in groups],
+                         [['Fever', 'Cough'], [], ['Rash']])
+        self.assertEqual(group_metamap_concepts([], 2), [[], []])
+
+    def test_sentences(self):
+        sents = metamap_sentences([[('Fever', 'C1', '[sosy]', '9.5')], []])
+        self.assertEqual(sents, [{'sent_id': 1, 'relations': [],
+                                  'entities': [{'label': 'Fever', 'cui': 'C1',
+                                                'sem_types': '[sosy]', 'score': '9.5'}]},
+                                 {'sent_id': 2, 'relations': [], 'entities': []}])
+
+
+if __name__ == '__main__':
+    unittest.main()
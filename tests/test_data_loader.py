@@ -0,0 +1,263 @@
+#!/usr/bin/python !/usr/bin/env python
+# -*- coding: utf-8 -*
+
+
+# Tests of the loaders and their batch helpers.
+
+import os
+import gzip
+import json
+import StringIO
+import shutil
+import tempfile
+import unittest
+import tests
+import data_loader
+from bson import ObjectId
+from data_loader import mongo_id_token, to_mongo_id, count_medical_records, JsonLinesBatchReader, \
+                        get_projection, MedRecBatchReader, iter_lines, get_file_format, \
+                        cut_by_chars, get_batch_chars
+
+
+class MongoIdTokenTest(unittest.TestCase):
+
+    def test_object_id(self):
+        _id = ObjectId('5d0b3c1e8f1b2a0c4c8e4f21')
+        token = mongo_id_token(_id)
+        self.assertEqual(token, 'ObjectId(5d0b3c1e8f1b2a0c4c8e4f21)')
+        self.assertEqual(to_mongo_id(token), _id)
+
+    def test_string_id(self):
+        # A string _id that looks like an ObjectId stays a string
+        token = mongo_id_token('5d0b3c1e8f1b2a0c4c8e4f21')
+        self.assertEqual(to_mongo_id(token), '5d0b3c1e8f1b2a0c4c8e4f21')
+        self.assertEqual(to_mongo_id(mongo_id_token(u'PMC123')), u'PMC123')
+
+    def test_other_ids(self):
+        self.assertEqual(to_mongo_id(mongo_id_token(42)), 42)
+        self.assertIsNone(to_mongo_id(None))
+        self.assertIsNone(to_mongo_id('None'))
+
+
+class IndexedCountTest(tests.SettingsTestCase):
+
+    def setUp(self):
+        super(IndexedCountTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.index_dir = os.path.join(self.dir, 'index')
+        os.mkdir(self.index_dir)
+        self.set_setting(['load', 'path', 'index_path'], self.index_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        super(IndexedCountTest, self).tearDown()
+
+    def count_calls(self, owner, func):
+        """
+        Wrap a function of a module, counting its calls.
+        """
+
+        calls = []
+        original = getattr(owner, func)
+
+        def wrapper(*args, **kwargs):
+            calls.append(args)
+            return original(*args, **kwargs)
+
+        setattr(owner, func, wrapper)
+        self.addCleanup(setattr, owner, func, original)
+        return calls
+
+    def test_json_lines(self):
+        path = os.path.join(self.dir, 'in.jsonl.gz')
+        f = gzip.open(path, 'wb')
+        f.write('{"id": 1}\n\n{"id": 2}\n{"id": 3}')
+        f.close()
+        calls = self.count_calls(data_loader, 'open_input_file')
+        self.assertEqual(JsonLinesBatchReader(path).count(), 3)
+        self.assertEqual(JsonLinesBatchReader(path).count(1), 2)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(os.listdir(self.index_dir), ['in.jsonl.gz.index'])
+        # Counted again when the file changes
+        os.utime(path, (1, 1))
+        self.assertEqual(JsonLinesBatchReader(path).count(), 3)
+        self.assertEqual(len(calls), 2)
+
+    def test_medical_records(self):
+        path = os.path.join(self.dir, 'records.tsv')
+        with open(path, 'w') as f:
+            f.write('AdmissionID\tDiag\nA1\tFever.\nA2\tCough.\n')
+        calls = self.count_calls(data_loader.pd, 'read_csv')
+        self.assertEqual(count_medical_records(path), 2)
+        self.assertEqual(count_medical_records(path), 2)
+        self.assertEqual(len(calls), 1)
+
+
+class GetProjectionTest(tests.SettingsTestCase):
+
+    def test_fields(self):
+        self.assertEqual(get_projection('text'), ['abstractText', 'pmid', 'title'])
+        self.assertEqual(get_projection('med_rec'), ['Diag', 'AdmissionID'])
+        self.set_setting(['load', 'text', 'labelfield'], 'None')
+        self.set_setting(['load', 'text', 'metadata_fields'], ['journal', 'year'])
+        self.assertEqual(get_projection('text'), ['abstractText', 'pmid', 'journal', 'year'])
+
+    def test_whole_documents(self):
+        self.assertIsNone(get_projection('edges'))
+        self.set_setting(['pipeline', 'out', 'json'], True)
+        self.assertIsNone(get_projection('text'))
+
+
+class JsonLinesBatchReaderTest(tests.SettingsTestCase):
+
+    def setUp(self):
+        super(JsonLinesBatchReaderTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.set_setting(['num_cores'], 1)
+        self.set_setting(['batch_per_core'], 2)
+        self.items = [{'pmid': i, 'abstractText': u'Caf\xe9 %d.' % i, 'mesh': ['a']} for i in xrange(5)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        super(JsonLinesBatchReaderTest, self).tearDown()
+
+    def write(self, name, opener=open):
+        """
+        Write the items to a JSON Lines file, with blank lines among them.
+        """
+
+        path = os.path.join(self.dir, name)
+        f = opener(path, 'wb')
+        f.write('\n\n'.join(json.dumps(item) for item in self.items) + '\r\n')
+        f.close()
+        return path
+
+    def read_all(self, reader, ind_=0):
+        """
+        Items of each batch and the token after it.
+        """
+
+        batches = []
+        while True:
+            json_, ind_ = reader.load_batch('text', 'unknown', ind_)
+            if json_ is None:
+                break
+            batches.append(([dict(item) for item in json_['documents']], ind_))
+            if ind_ is None:
+                break
+        reader.close()
+        return batches
+
+    def test_batches(self):
+        for path in [self.write('in.jsonl'), self.write('in.jsonl.gz', gzip.open)]:
+            batches = self.read_all(JsonLinesBatchReader(path))
+            self.assertEqual([ind_ for _, ind_ in batches], [2, 4, None])
+            self.assertEqual([item for items, _ in batches for item in items], self.items)
+
+    def test_projection_resume(self):
+        reader = JsonLinesBatchReader(self.write('in.jsonl'), ['pmid'])
+        # A full batch at the end of the file still hands out a token
+        self.assertEqual(self.read_all(reader, 3), [([{'pmid': 3}, {'pmid': 4}], 5)])
+        self.assertEqual(reader.load_batch('text', 5, 5), (None, None))
+
+    def test_batch_chars(self):
+        self.set_setting(['batch_per_core'], 10)
+        self.set_setting(['batch_chars'], 1)
+        batches = self.read_all(JsonLinesBatchReader(self.write('in.jsonl')))
+        self.assertEqual([len(items) for items, _ in batches], [1, 1, 1, 1, 1])
+        self.assertEqual([ind_ for _, ind_ in batches], [1, 2, 3, 4, 5])
+
+    def test_lazy(self):
+        self.set_setting(['load', 'path', 'lazy_records'], True)
+        reader = JsonLinesBatchReader(self.write('in.jsonl'), ['pmid', 'abstractText'])
+        items = [item for items, _ in self.read_all(reader) for item in items]
+        self.assertEqual(items, [{'pmid': i, 'abstractText': u'Caf\xe9 %d.' % i} for i in xrange(5)])
+
+    def test_iter_lines(self):
+        f = StringIO.StringIO('a\n\n  \nbc\nd')
+        self.assertEqual(list(iter_lines(f, size=2)), ['a', 'bc', 'd'])
+
+    def test_file_format(self):
+        self.assertEqual(get_file_format('in.jsonl.gz'), 'jsonl')
+        self.assertEqual(get_file_format('in.ndjson'), 'jsonl')
+        self.assertEqual(get_file_format('in.json'), 'json')
+
+
+class CutByCharsTest(tests.SettingsTestCase):
+
+    def test_cut(self):
+        self.assertEqual(cut_by_chars([3, 3, 3, 3], 6), 2)
+        self.assertEqual(cut_by_chars([3, 3, 3, 3], 7), 3)
+        self.assertEqual(cut_by_chars(iter([5, 5, 5]), 10), 2)
+
+    def test_at_least_one(self):
+        self.assertEqual(cut_by_chars([100, 1], 10), 1)
+        self.assertEqual(cut_by_chars([0, 0], 0), 1)
+
+    def test_under_budget(self):
+        self.assertEqual(cut_by_chars([1, 2], 100), 2)
+        self.assertEqual(cut_by_chars([], 100), 0)
+
+    def test_setting(self):
+        self.assertIsNone(get_batch_chars())
+        self.set_setting(['batch_chars'], '5000')
+        self.assertEqual(get_batch_chars(), 5000)
+
+
+class MedRecBatchReaderTest(tests.SettingsTestCase):
+
+    def setUp(self):
+        super(MedRecBatchReaderTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'records.tsv')
+        with open(self.path, 'w') as f:
+            f.write('idx\tAdmissionID\tDiag\tOther\n')
+            for i in xrange(7):
+                f.write('%d\tA%d\tFever %d.\tjunk\n' % (i, i, i))
+        self.set_setting(['num_cores'], 1)
+        self.set_setting(['batch_per_core'], 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        super(MedRecBatchReaderTest, self).tearDown()
+
+    def read_all(self, reader, ind_=0):
+        """
+        Ids of each batch, till the reader returns no token.
+        """
+
+        batches = []
+        while True:
+            json_, ind_ = reader.load_batch('med_rec', 'unknown', ind_)
+            if json_ is None:
+                break
+            batches.append([doc['id'] for doc in json_['documents']])
+            if ind_ is None:
+                break
+        return batches
+
+    def test_batches(self):
+        reader = MedRecBatchReader(self.path, ['Diag', 'AdmissionID'])
+        self.assertEqual(self.read_all(reader), [['A0', 'A1', 'A2'], ['A3', 'A4', 'A5'], ['A6']])
+
+    def test_projection(self):
+        json_, ind_ = MedRecBatchReader(self.path, ['Diag', 'AdmissionID']).load_batch('med_rec', 7, 0)
+        self.assertEqual(ind_, 3)
+        self.assertEqual(json_['documents'][0]['text'], 'Fever 0.')
+        self.assertFalse('Other' in json_['documents'][0])
+        json_, _ = MedRecBatchReader(self.path).load_batch('med_rec', 7, 0)
+        self.assertEqual(json_['documents'][0]['Other'], 'junk')
+
+    def test_resume(self):
+        reader = MedRecBatchReader(self.path)
+        self.assertEqual(self.read_all(reader, 5), [['A5', 'A6']])
+        self.assertEqual(self.read_all(MedRecBatchReader(self.path), 7), [])
+
+    def test_exact_end(self):
+        self.set_setting(['batch_per_core'], 7)
+        reader = MedRecBatchReader(self.path)
+        self.assertEqual(self.read_all(reader), [['A%d' % i for i in xrange(7)]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python !/usr/bin/env python
+# -*- coding: utf-8 -*
+
+
+# Tests of the materialized store of extracted documents and its replay.
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import tests
+import extraction_store
+from extraction_store import ExtractionStore, store_documents
+from data_loader import load_replay, load_replay_batches
+from json_stream import LazyRecord
+
+
+class ExtractionStoreTest(tests.SettingsTestCase):
+
+    def setUp(self):
+        super(ExtractionStoreTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'store')
+        self.set_setting(['store', 'path'], self.path)
+        self.set_setting(['pipeline', 'in', 'stream'], False)
+        self.set_setting(['num_cores'], 1)
+        self.set_setting(['batch_per_core'], 2)
+        extraction_store._EXTRACTION_STORE = None
+
+    def tearDown(self):
+        extraction_store._EXTRACTION_STORE = None
+        shutil.rmtree(self.dir)
+        super(ExtractionStoreTest, self).tearDown()
+
+    def test_put_read(self):
+        store = ExtractionStore(self.path)
+        store.put_many([{'id': 'a', 'text': 'A'}, {'id': 'b', 'text': 'B'}], 'id')
+        store.put_many([{'id': 'a', 'text': 'A2'}, {'id': 'c', 'text': 'C'}], 'id')
+        # First stored order, last stored record
+        self.assertEqual(store.read(), [{'id': 'a', 'text': 'A2'}, {'id': 'b', 'text': 'B'},
+                                        {'id': 'c', 'text': 'C'}])
+        reopened = ExtractionStore(self.path)
+        self.assertEqual(len(reopened), 3)
+        self.assertEqual(reopened.read(1, 2), [{'id': 'b', 'text': 'B'}])
+
+    def test_old_index(self):
+        # Index lines of older stores also kept the hash of the text
+        store = ExtractionStore(self.path)
+        store.put_many([{'id': 'a', 'text': 'A'}], 'id')
+        with open(self.path + '.idx') as f:
+            doc_id, offset, length = json.loads(f.read())
+        with open(self.path + '.idx', 'w') as f:
+            f.write('["a", "hash", %d, %d]\n' % (offset, length))
+        self.assertEqual(ExtractionStore(self.path).read(), [{'id': 'a', 'text': 'A'}])
+
+    def test_store_documents(self):
+        docs = [{'id': 1, 'text': 'A', 'sents': []}, {'id': 2, 'subject': 'C1'},
+                LazyRecord('{"id": 3, "text": "B"}')]
+        store_documents({'documents': docs})
+        # Only documents with the text field are stored
+        self.assertEqual(load_replay('text'), {'documents': [{'id': 1, 'text': 'A', 'sents': []},
+                                                             {'id': 3, 'text': 'B'}]})
+        store_documents({'relations': [{'id': 4}]})
+        self.assertEqual(len(extraction_store.get_extraction_store()), 2)
+
+    def test_replay_batches(self):
+        store_documents({'documents': [{'id': i, 'text': str(i)} for i in xrange(3)]})
+        json_, ind_ = load_replay_batches('text', 3, 0)
+        self.assertEqual(([doc['id'] for doc in json_['documents']], ind_), ([0, 1], 2))
+        json_, ind_ = load_replay_batches('text', 3, ind_)
+        self.assertEqual(([doc['id'] for doc in json_['documents']], ind_), ([2], 3))
+        self.assertEqual(load_replay_batches('text', 3, ind_), (None, None))
+
+    def test_replay_without_store(self):
+        self.set_setting(['store', 'path'], None)
+        self.assertRaises(ValueError, load_replay, 'text')
+        self.assertRaises(ValueError, load_replay_batches, 'text', 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
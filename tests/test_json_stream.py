@@ -0,0 +1,174 @@
+#!/usr/bin/python !/usr/bin/env python
+# -*- coding: utf-8 -*
+
+
+# Tests of the raw json helpers: array spans, lazy records and the sidecar index.
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from json_stream import find_json_array, iter_json_array, JsonArrayIndex, LazyRecord, dumps_json
+
+
+def raw_items(buf, itemfield='documents'):
+    """
+    Raw items of the array under itemfield.
+    """
+
+    pos = find_json_array(buf, itemfield)
+    return [buf[start:end] for start, end, _ in iter_json_array(buf, pos)]
+
+
+class FindJsonArrayTest(unittest.TestCase):
+
+    def test_outer_key(self):
+        buf = '{"meta": {"documents": [1]}, "documents": [2, 3]}'
+        self.assertEqual(raw_items(buf), ['2', '3'])
+
+    def test_key_inside_string(self):
+        buf = '{"title": "\\"documents\\": [", "documents": [{"a": 1}]}'
+        self.assertEqual(raw_items(buf), ['{"a": 1}'])
+
+    def test_missing(self):
+        self.assertIsNone(find_json_array('{"relations": []}', 'documents'))
+        self.assertIsNone(find_json_array('', 'documents'))
+
+
+class IterJsonArrayTest(unittest.TestCase):
+
+    def test_brackets_and_quotes_in_strings(self):
+        items = ['{"text": "a ] b } c, d"}', '{"text": "say \\"[x, y]\\""}', '"\\\\"']
+        buf = '{"documents": [%s]}' % ', '.join(items)
+        self.assertEqual(raw_items(buf), items)
+        self.assertEqual([json.loads(item) for item in raw_items(buf)],
+                         [json.loads(item) for item in items])
+
+    def test_nested(self):
+        buf = '{"documents": [ {"a": [1, {"b": [2]}]} ,[3, 4], 5 ]}'
+        self.assertEqual(raw_items(buf), ['{"a": [1, {"b": [2]}]}', '[3, 4]', '5'])
+
+    def test_empty(self):
+        self.assertEqual(raw_items('{"documents": []}'), [])
+        self.assertEqual(raw_items('{"documents": [ \n ]}'), [])
+
+    def test_missing_end(self):
+        # A truncated file yields the complete items only
+        buf = '{"documents": [{"a": 1}, {"b": 2}, {"c"'
+        self.assertEqual(raw_items(buf), ['{"a": 1}', '{"b": 2}'])
+
+    def test_resume(self):
+        buf = '{"documents": [1, 2, 3]}'
+        pos = find_json_array(buf, 'documents')
+        next_pos = list(iter_json_array(buf, pos))[0][2]
+        self.assertEqual([buf[start:end] for start, end, _ in iter_json_array(buf, next_pos)],
+                         ['2', '3'])
+
+
+class JsonArrayIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'in.json.index')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_build(self):
+        buf = '{"documents": [{"a": "]"}, {"b": 2}]}'
+        index = JsonArrayIndex.build(buf, 'documents')
+        self.assertEqual(len(index), 2)
+        self.assertEqual([buf[start:end] for start, end in zip(index.starts, index.ends)],
+                         ['{"a": "]"}', '{"b": 2}'])
+        self.assertEqual(index.locate(None), 0)
+        self.assertEqual(index.locate(index.offset_of(1)), 1)
+        self.assertEqual(index.locate(index.ends[0]), 1)
+        self.assertIsNone(index.offset_of(2))
+
+    def test_build_missing(self):
+        self.assertEqual(len(JsonArrayIndex.build('{"relations": [1]}', 'documents')), 0)
+        self.assertEqual(len(JsonArrayIndex.build('{"documents": []}', 'documents')), 0)
+
+    def test_save_load(self):
+        index = JsonArrayIndex.build('{"documents": [1, 22, 333]}', 'documents')
+        index.save(self.path, 27, 1.5, 'documents')
+        loaded = JsonArrayIndex.load(self.path, 27, 1.5, 'documents')
+        self.assertEqual(list(loaded.starts), list(index.starts))
+        self.assertEqual(list(loaded.ends), list(index.ends))
+        self.assertEqual(os.listdir(self.dir), ['in.json.index'])
+
+    def test_load_stale(self):
+        JsonArrayIndex.build('{"documents": [1]}', 'documents').save(self.path, 18, 1.5, 'documents')
+        self.assertIsNone(JsonArrayIndex.load(self.path, 19, 1.5, 'documents'))
+        self.assertIsNone(JsonArrayIndex.load(self.path, 18, 2.5, 'documents'))
+        self.assertIsNone(JsonArrayIndex.load(self.path, 18, 1.5, 'relations'))
+        self.assertIsNone(JsonArrayIndex.load(self.path + '.missing', 18, 1.5, 'documents'))
+
+
+class LazyRecordTest(unittest.TestCase):
+
+    raw = '{"id": 7, "text": "a \\"b\\" }", "mesh": [1, {"x": null}], "title": "T"}'
+
+    def test_get(self):
+        record = LazyRecord(self.raw)
+        self.assertEqual(record['text'], u'a "b" }')
+        self.assertEqual(record.get('missing', 1), 1)
+        self.assertEqual(list(record), ['id', 'text', 'mesh', 'title'])
+        self.assertEqual(record.materialize(), json.loads(self.raw))
+
+    def test_fields(self):
+        record = LazyRecord(self.raw, ['id', 'mesh', 'missing'])
+        self.assertEqual(len(record), 2)
+        self.assertNotIn('text', record)
+        self.assertRaises(KeyError, lambda: record['text'])
+        self.assertEqual(json.loads(record.dumps()), {'id': 7, 'mesh': [1, {'x': None}]})
+
+    def test_empty(self):
+        record = LazyRecord('{ }')
+        self.assertEqual(len(record), 0)
+        self.assertEqual(json.loads(record.dumps()), {})
+
+    def test_duplicate_keys(self):
+        # The last value wins, as with json.loads
+        record = LazyRecord('{"a": 1, "b": 2, "a": 3}')
+        self.assertEqual(list(record), ['a', 'b'])
+        self.assertEqual(record['a'], 3)
+
+    def test_set_delete(self):
+        record = LazyRecord(self.raw)
+        record['sents'] = ['s']
+        record['id'] = 8
+        del record['mesh']
+        self.assertEqual(list(record), ['id', 'text', 'title', 'sents'])
+        self.assertRaises(KeyError, record.__delitem__, 'mesh')
+        self.assertEqual(json.loads(record.dumps()),
+                         {'id': 8, 'text': u'a "b" }', 'title': 'T', 'sents': ['s']})
+
+    def test_untouched(self):
+        self.assertEqual(LazyRecord(self.raw).dumps(), self.raw)
+        record = LazyRecord(self.raw)
+        record['id'] = 8
+        # Fields never decoded are copied verbatim
+        self.assertIn('"mesh": [1, {"x": null}]', record.dumps())
+
+
+class DumpsJsonTest(unittest.TestCase):
+
+    def test_plain(self):
+        obj = {'documents': [{'id': 1}], 'relations': []}
+        self.assertEqual(dumps_json(obj), json.dumps(obj))
+
+    def test_lazy(self):
+        record = LazyRecord('{"id": 1, "text": "x\\u00e9"}')
+        record['sents'] = []
+        obj = {'documents': [record, {'id': 2}]}
+        self.assertEqual(json.loads(dumps_json(obj, indent=2)),
+                         {'documents': [{'id': 1, 'text': u'x\xe9', 'sents': []}, {'id': 2}]})
+
+    def test_not_serializable(self):
+        self.assertRaises(TypeError, dumps_json, {'a': object()})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/python !/usr/bin/env python
+# -*- coding: utf-8 -*
+
+
+# Tests of the ledger of processed documents of the incremental mode.
+
+import os
+import shutil
+import tempfile
+import unittest
+import tests
+import ledger
+from ledger import ProcessedLedger, get_processed_ledger
+
+
+class ProcessedLedgerTest(tests.SettingsTestCase):
+
+    def setUp(self):
+        super(ProcessedLedgerTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'processed.ledger')
+        ledger._PROCESSED_LEDGER = None
+
+    def tearDown(self):
+        ledger._PROCESSED_LEDGER = None
+        shutil.rmtree(self.dir)
+        super(ProcessedLedgerTest, self).tearDown()
+
+    def test_add(self):
+        processed = ProcessedLedger(self.path)
+        processed.add(['a', 'b'])
+        processed.add(['b', 3], watermark='ObjectId(5d0b3c1e8f1b2a0c4c8e4f21)')
+        self.assertEqual(len(processed), 3)
+        self.assertTrue('b' in processed)
+        self.assertFalse('c' in processed)
+        # Each id is written once
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 4)
+        reopened = ProcessedLedger(self.path)
+        self.assertEqual(reopened.ids, set(['a', 'b', 3]))
+        self.assertEqual(reopened.watermark, 'ObjectId(5d0b3c1e8f1b2a0c4c8e4f21)')
+
+    def test_last_watermark(self):
+        processed = ProcessedLedger(self.path)
+        processed.add([], watermark=1)
+        processed.add([], watermark=2)
+        self.assertEqual(ProcessedLedger(self.path).watermark, 2)
+
+    def test_get(self):
+        self.assertIsNone(get_processed_ledger())
+        self.set_setting(['load', 'incremental'], {'enabled': True, 'ledger_path': self.path})
+        processed = get_processed_ledger()
+        self.assertEqual(processed.path, self.path)
+        self.assertIs(get_processed_ledger(), processed)
+
+
+if __name__ == '__main__':
+    unittest.main()
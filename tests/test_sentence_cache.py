@@ -0,0 +1,72 @@
+#!/usr/bin/python !/usr/bin/env python
+# -*- coding: utf-8 -*
+
+
+# Tests of the on-disk cache of SemRep sentence results.
+
+import os
+import shutil
+import tempfile
+import unittest
+import tests
+import sentence_cache
+from sentence_cache import SentenceCache
+
+
+class SentenceCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_key(self):
+        cache = SentenceCache(self.path, version='semrep -F')
+        self.assertEqual(cache.key(u'Caf\xe9.'), cache.key('Caf\xc3\xa9.'))
+        self.assertNotEqual(cache.key('Fever.'), SentenceCache(self.path, version='other').key('Fever.'))
+
+    def test_get_put(self):
+        cache = SentenceCache(self.path)
+        value = [{'sent_text': 'Fever.', 'entities': [{'cuid': 'C1'}], 'relations': []}]
+        cache.put_many({'a': value, 'b': []})
+        self.assertEqual(cache.get_many(['a', 'b', 'c', 'a']), {'a': value, 'b': []})
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        # Reopened from the file
+        self.assertEqual(SentenceCache(self.path).get_many(['a']), {'a': value})
+
+    def test_access_refresh(self):
+        cache = SentenceCache(self.path)
+        cache.put_many({'a': [], 'b': []})
+        cache.conn.execute('UPDATE cache SET accessed = 1')
+        cache.conn.execute('UPDATE cache SET accessed = ? WHERE key = ?', (1e12, 'b'))
+        cache.conn.commit()
+        cache.get_many(['a', 'b'])
+        accessed = dict(cache.conn.execute('SELECT key, accessed FROM cache'))
+        # Only the stale access time is written
+        self.assertGreater(accessed['a'], 1)
+        self.assertEqual(accessed['b'], 1e12)
+
+    def test_evict(self):
+        cache = SentenceCache(self.path, max_bytes=2000)
+        for i in xrange(40):
+            cache.put_many({'s%d' % i: [{'sent_text': os.urandom(150).encode('hex')}]})
+        self.assertEqual(cache.total, cache.stored_size())
+        self.assertLessEqual(cache.total, 2000)
+        # The least recently used are gone
+        self.assertEqual(cache.get_many(['s0']), {})
+        self.assertTrue(cache.get_many(['s39']))
+
+    def test_evict_check(self):
+        # Values stored by other workers are found every EVICT_CHECK puts
+        cache = SentenceCache(self.path, max_bytes=10 ** 6)
+        other = SentenceCache(self.path, max_bytes=10 ** 6)
+        other.put_many({'other': [{'sent_text': 'x' * 100}]})
+        for i in xrange(sentence_cache.EVICT_CHECK):
+            cache.put_many({'s%d' % i: []})
+        self.assertEqual(cache.total, cache.stored_size())
+
+
+if __name__ == '__main__':
+    unittest.main()
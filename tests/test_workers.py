@@ -0,0 +1,26 @@
+#!/usr/bin/python !/usr/bin/env python
+# -*- coding: utf-8 -*
+
+
+# Tests of the helpers of the shared pool of workers.
+
+import unittest
+import tests
+from workers import pack_payload, unpack_payload, pickled_size
+
+
+class PackPayloadTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        payload = [(0, [('1', u'Caf\xe9.', [('C1', 'a', 'dsyn', '1000')], [])]),
+                   (3, []), (None, {'a': 1.5, 'b': (True, 'x' * 1000)})]
+        self.assertEqual(unpack_payload(pack_payload(payload)), payload)
+
+    def test_smaller(self):
+        payload = [(i, [('sent %d' % i, [('C0000001', 'Fever', 'sosy', '1000')] * 5)])
+                   for i in xrange(100)]
+        self.assertLess(pickled_size(pack_payload(payload)), pickled_size(payload))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,9 +17,10 @@ from Authentication import Authentication
 # API-kEY FOR UMLS REST TICKET SERVICES
 umls_api = settings['apis']['umls']
 # UMLS REST SERVICES INITIALIZATION OF CLIENT AND TICKET
-# GRANTING SERVICE TO BE USED IN ALL CASES
+# GRANTING SERVICE TO BE USED IN ALL CASES. No ticket is requested
+# without an api-key (e.g. in the tests)
 AuthClient = Authentication(umls_api)
-tgt = AuthClient.gettgt()
+tgt = AuthClient.gettgt() if str(umls_api) != 'None' else None
 
 # To supress some kind of warning?!
 logging.getLogger("requests").setLevel(logging.WARNING)
@@ -0,0 +1,238 @@
+#!/usr/bin/python !/usr/bin/env python
+# -*- coding: utf-8 -*
+
+
+# Pipeline-scoped pool of worker processes. The pool is created once,
+# each worker warms up its tokenizer, extractor processes and db clients
+# and every batch/stage of the pipeline reuses it.
+
+import os
+import zlib
+import marshal
+import cPickle
+import threading
+import py2neo
+import pymongo
+from config import settings, get_setting
+from utilities import time_log
+from multiprocessing import cpu_count, Pool
+
+
+# The pool shared across the pipeline. The lock guards its creation, as
+# batches can be read in a background thread
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+# Db clients of the current process, keyed by pid as they can't be
+# shared with forked processes
+_MONGO_CLIENTS = {}
+_NEO4J_GRAPHS = {}
+
+
+def get_num_workers():
+    """
+    Helper function to get the number of workers from settings.
+    Output:
+        - N_THREADS: int, num_cores or the cpu count
+    """
+
+    try:
+        N_THREADS = int(settings['num_cores'])
+    except:
+        N_THREADS = cpu_count()
+    return N_THREADS
+
+
+def warm_up(name, func, *args):
+    """
+    Call one of the warm-ups of init_worker, logging its failure. The
+    pool respawns workers whose initializer raises without end, while
+    the tasks start what they need lazily and fall back on their own.
+    Input:
+        - name: str,
+        what is warmed up, for the log
+        - func: function,
+        the function to call with args
+    """
+
+    try:
+        func(*args)
+    except Exception, e:
+        time_log('Worker %d could not warm up the %s: %s' % (os.getpid(), name, e))
+
+
+def init_worker():
+    """
+    Initializer of each worker of the pool. Loads the NLTK punkt
+    model and starts the extractors and db clients the configured
+    pipeline will need, so that the first task doesn't pay for them.
+    Failures are only logged (see warm_up).
+    """
+
+    try:
+        from nltk.tokenize import sent_tokenize
+        from data_extractor import get_semrep_process, get_metamap_process, SEMREP_BIN, SEMREP_FLAGS
+        from sentence_cache import get_sentence_cache
+    except Exception, e:
+        time_log('Worker %d could not warm up: %s' % (os.getpid(), e))
+        return
+
+    trans = settings['pipeline']['trans']
+    out = settings['pipeline']['out']
+    warm_up('tokenizer', sent_tokenize, 'Warm up the tokenizer. Once per worker.')
+    if settings['pipeline']['in'].get('type') == 'text':
+        warm_up('language model', classify_language, 'Warm up the language model. Once per worker.')
+    if str(trans.get('semrep')) == 'True':
+        if str(get_setting(['semrep', 'persistent'], False)) == 'True':
+            warm_up('SemRep process', lambda: get_semrep_process().start())
+        warm_up('sentence cache', get_sentence_cache, SEMREP_BIN + ' ' + SEMREP_FLAGS)
+    if str(trans.get('metamap')) == 'True':
+        if str(get_setting(['metamap', 'persistent'], False)) == 'True':
+            warm_up('MetaMap process', lambda: get_metamap_process().start())
+    if str(trans.get('get_concepts_from_edges')) == 'True':
+        warm_up('mongo client', get_mongo_client, settings['load']['mongo']['uri'])
+    if str(out.get('neo4j')) == 'True':
+        warm_up('neo4j graph', get_neo4j_graph)
+
+
+def classify_language(text):
+    """
+    Classify a text with langid, importing it on first use.
+    """
+
+    import langid
+    return langid.classify(text)
+
+
+def get_recycle_tasks():
+    """
+    Helper function to get the number of tasks after which each worker
+    is replaced, read from recycle_tasks in settings. Replacements are
+    forked while the pipeline runs, so this can't be used along with
+    background reading threads (see taskCoordinator.run).
+    Output:
+        - recycle: int, or None to keep the workers for the whole run
+    """
+
+    recycle = get_setting(['recycle_tasks'], None)
+    if recycle is None or str(recycle) == 'None':
+        return None
+    return int(recycle)
+
+
+def get_pool():
+    """
+    Get the pool shared across the pipeline, creating it if needed.
+    If recycle_tasks is set in settings, each worker is replaced after
+    that many tasks to cap memory growth.
+    Output:
+        - multiprocessing.Pool instance
+    """
+
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            N_THREADS = get_num_workers()
+            _POOL = Pool(N_THREADS, initializer=init_worker, maxtasksperchild=get_recycle_tasks())
+            time_log('Started a pool of %d workers!' % N_THREADS)
+    return _POOL
+
+
+def close_pool():
+    """
+    Close the shared pool, waiting for the workers to exit.
+    """
+
+    global _POOL
+    if _POOL is not None:
+        _POOL.close()
+        _POOL.join()
+        _POOL = None
+
+
+def get_mongo_client(uri):
+    """
+    Get a mongo client for the uri, reusing the one of the current
+    process if already connected.
+    Input:
+        - uri: str,
+        DB full uri
+    Output:
+        - pymongo.MongoClient instance
+    """
+
+    key = (os.getpid(), uri)
+    if not(key in _MONGO_CLIENTS):
+        _MONGO_CLIENTS[key] = pymongo.MongoClient(uri)
+    return _MONGO_CLIENTS[key]
+
+
+def get_neo4j_graph():
+    """
+    Get a connection to the neo4j db of the settings, reusing the one
+    of the current process if already connected.
+    Output:
+        - py2neo.Graph instance
+    """
+
+    pid = os.getpid()
+    if not(pid in _NEO4J_GRAPHS):
+        _NEO4J_GRAPHS[pid] = py2neo.Graph(host=settings['neo4j']['host'],
+                                          port=settings['neo4j']['port'],
+                                          user=settings['neo4j']['user'],
+                                          password=settings['neo4j']['password'])
+    return _NEO4J_GRAPHS[pid]
+
+
+def pack_payload(obj):
+    """
+    Pack plain python data (tuples, lists, strings, numbers) in a
+    compact binary form to be sent between processes.
+    Input:
+        - obj: the data to pack
+    Output:
+        - str, the packed data
+    """
+
+    return zlib.compress(marshal.dumps(obj), 1)
+
+
+def unpack_payload(packed):
+    """
+    Inverse of pack_payload.
+    Input:
+        - packed: str, data packed with pack_payload
+    Output:
+        - the unpacked data
+    """
+
+    return marshal.loads(zlib.decompress(packed))
+
+
+def pickled_size(obj):
+    """
+    Number of bytes obj takes when pickled, as multiprocessing does
+    when sending it to or from a worker.
+    """
+
+    return len(cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL))
+
+
+def log_ipc_sizes(name, full_in, full_out, sent, received):
+    """
+    Log the bytes pickled between the parent and the workers for a
+    batch, against what sending whole documents would cost.
+    Input:
+        - name: str, the name of the stage
+        - full_in, full_out: int, bytes of the whole documents to and
+        from the workers
+        - sent, received: int, bytes actually sent to and from the workers
+    """
+
+    full = full_in + full_out
+    actual = sent + received
+    time_log('%s IPC: sent %d bytes (whole documents: %d) | received %d bytes (whole documents: %d)' %
+             (name, sent, full_in, received, full_out))
+    if full:
+        time_log('%s IPC: %d instead of %d bytes -- %0.2f %% less' %
+                 (name, actual, full, 100 * (full - actual) / float(full)))